@@ -0,0 +1,381 @@
+#
+#  Stage timings for the figure pipeline on the bundled images/ set.
+#
+#    python benchmark.py                      run and print the timings
+#    python benchmark.py --save base.json     also store them as a baseline
+#    python benchmark.py --baseline base.json compare, exit 1 on regressions
+#    python benchmark.py --check              check the fast paths against the
+#                                             slow ones, exit 1 on a mismatch
+#
+#  Every repetition runs in a fresh temporary directory, so crop, FLIP and
+#  metric caches are cold unless a stage says otherwise.
+
+from pathlib import Path
+import argparse
+import subprocess
+import shutil
+import tempfile
+import json
+import time
+import sys
+import os
+
+import main
+
+images_dir = (Path(__file__).parent/"images").resolve()
+ref        = str(images_dir/"eaw_japan-4000spp.png")
+iters      = [str(images_dir/("eaw_japan-4spp-%d-iter-p+n.png" % i)) for i in range(1, 6)]
+variants   = [(name, *[str(images_dir/("eaw_japan-4spp-%d-iter%s.png" % (i, suffix))) for i in range(1, 6)])
+              for name, suffix in (("C+P+N", "-p+n"), ("C+P", "-p"), ("C+N", "-n"), ("C", ""))]
+box1, box2 = (0.5, 2.5, 3.5), (5.5, 2, 3)
+ref_crop   = (0, 1.5, 0, 2)
+
+def have_flip():
+    return (Path(main.__file__).parent/"flip"/"python"/"flip.py").exists()
+
+def have_pdflatex():
+    return shutil.which("pdflatex") is not None
+
+def reset_caches():
+    main.image_store.clear()
+    main._file_hashes.clear()
+    main._flip_references.clear()
+    main._reference_metrics.clear()
+    main._metrics_db = None
+
+## ----------------------
+##        stages
+## ----------------------
+
+def stage_startup():
+    # interpreter start until the first line of output
+    subprocess.run([sys.executable, main.__file__, "--help"], check=True, stdout=subprocess.DEVNULL)
+
+def stage_startup_tex_only():
+    # a whole --tex-only build in a fresh interpreter, which must not pull in
+    #   the metrics stack
+    with open("manifest.json", "w") as out_file:
+        json.dump({"figures": [{"type": "one_line", "output": "one_line.tex",
+                                "args": {"ref": ["ref", ref], "box1": box1, "box2": box2,
+                                         "cmp1": ["1", iters[0]], "cmp2": ["2", iters[1]]}}]}, out_file)
+    check = ("import sys; sys.path.insert(0, %r); import main; status = main.main(['manifest.json', '--tex-only']); "
+             "loaded = {'numpy', 'skimage', 'scipy'} & set(sys.modules); "
+             "sys.exit('metrics stack imported: ' + ', '.join(sorted(loaded)) if loaded else status)"
+             % str(Path(main.__file__).parent))
+    subprocess.run([sys.executable, "-c", check], check=True, stdout=subprocess.DEVNULL)
+
+def stage_decode():
+    main.image_store.load(ref)
+
+def stage_crop():
+    res = main.image_store.size(ref)
+    for box in (box1, box2):
+        for path in [ref] + iters:
+            main.create_cropped_image(path, main.calc_box_dim(box, res[0] / res[1]))
+    main.wait_for_encodes()
+
+def stage_metrics():
+    for img in iters:
+        main.get_similarity_values(ref, img)
+
+def stage_metrics_batch():
+    main.get_similarity_values_batch(ref, iters)
+
+def stage_boxes():
+    main.auto_boxes(ref, iters, [box1[2], box2[2]], ref_crop)
+
+def stage_metrics_tiled():
+    main.metrics_engine = "tiled"
+    try:
+        main.get_similarity_values_batch(ref, iters)
+    finally:
+        main.metrics_engine = "batch"
+
+def stage_flip():
+    for img in iters:
+        main.create_flip_image_and_stats(ref, img)
+
+def stage_tex():
+    # NOTE: crops are warmed first, only the emission itself is timed
+    main.one_line_figure(main.TexWriter(), ref=("ref", ref), box1=box1, box2=box2,
+                         cmp1=("1", iters[0]), cmp2=("2", iters[1]))
+    main.wait_for_encodes()
+    start = time.perf_counter()
+    for _ in range(10):
+        main.one_line_figure(main.TexWriter(), ref=("ref", ref), box1=box1, box2=box2,
+                             cmp1=("1", iters[0]), cmp2=("2", iters[1]))
+    return (time.perf_counter() - start) / 10
+
+def stage_pdflatex():
+    writer = main.TexWriter()
+    main.one_line_figure(writer, ref=("ref", ref), box1=box1, box2=box2, cmp1=("1", iters[0]))
+    main.make_latex_standalone("bench.tex", writer)
+
+def figure_one_line():
+    main.make_latex_standalone("one_line.tex", build(main.one_line_figure, ref=("ref", ref), box1=box1, box2=box2,
+                                                     cmp1=("1", iters[0]), cmp2=("2", iters[1])),
+                               compile=have_pdflatex())
+
+def figure_vertical_flip():
+    main.make_latex_standalone("vertical_flip.tex", build(main.vertical_flip_figure, ref=("ref", ref), box1=box1, box2=box2,
+                                                          ref_crop=ref_crop, cmps=[(str(i), p) for i, p in enumerate(iters)]),
+                               compile=have_pdflatex())
+
+def figure_vertical_flip_preview():
+    main.metrics_preview = True
+    try:
+        figure_vertical_flip()
+    finally:
+        main.metrics_preview = False
+
+def figure_single_flip():
+    main.make_latex_standalone("single_flip.tex", build(main.single_flip_figure, ref=("ref", ref), box1=box1, box2=box2,
+                                                        ref_crop=ref_crop, cmp=("1", iters[0])),
+                               compile=have_pdflatex())
+
+def figure_horizontal_iterations():
+    main.make_latex_standalone("horiz.tex", build(main.horizontal_iterations_figure, ref=("ref", ref), box1=box1, box2=box2,
+                                                  ref_crop=ref_crop, cmp1=variants[0], cmp2=variants[1],
+                                                  cmp3=variants[2], cmp4=variants[3]),
+                               compile=have_pdflatex())
+
+def raster(kind, **args):
+    # NOTE: like stage_tex, decoding and the caches are warmed first; only the
+    #   compositing and the PNG are timed
+    main.raster_figure("raster.png", kind, **args)
+    start = time.perf_counter()
+    main.raster_figure("raster.png", kind, **args)
+    return time.perf_counter() - start
+
+def raster_one_line():
+    return raster("one_line", ref=("ref", ref), box1=box1, box2=box2, cmp1=("1", iters[0]), cmp2=("2", iters[1]))
+
+def raster_vertical_flip():
+    return raster("vertical_flip", ref=("ref", ref), box1=box1, box2=box2, ref_crop=ref_crop,
+                  cmps=[(str(i), p) for i, p in enumerate(iters)])
+
+def build(builder, **args):
+    writer = main.TexWriter()
+    builder(out_list=writer, **args)
+    return writer
+
+# name -> (function, requirement)
+stages = {
+    "startup":                     (stage_startup,       None),
+    "startup.tex_only":            (stage_startup_tex_only, None),
+    "decode":                      (stage_decode,        None),
+    "crop":                        (stage_crop,          None),
+    "metrics":                     (stage_metrics,       None),
+    "metrics_batch":               (stage_metrics_batch, None),
+    "boxes":                       (stage_boxes,         None),
+    "metrics_tiled":               (stage_metrics_tiled, None),
+    "flip":                        (stage_flip,          have_flip),
+    "tex":                         (stage_tex,           None),
+    "pdflatex":                    (stage_pdflatex,      have_pdflatex),
+    "raster.one_line":             (raster_one_line,     None),
+    "raster.vertical_flip":        (raster_vertical_flip, have_flip),
+    "figure.one_line":             (figure_one_line,     None),
+    "figure.vertical_flip":        (figure_vertical_flip, have_flip),
+    "figure.vertical_flip.preview": (figure_vertical_flip_preview, have_flip),
+    "figure.single_flip":          (figure_single_flip,  have_flip),
+    "figure.horizontal_iterations": (figure_horizontal_iterations, have_flip),
+}
+
+def time_stage(func, repeat):
+    best = None
+    for _ in range(repeat):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                reset_caches()
+                main.metrics_db_path = str(Path(tmp)/"metrics.sqlite")
+                start   = time.perf_counter()
+                elapsed = func()
+                if elapsed is None:
+                    elapsed = time.perf_counter() - start
+            finally:
+                os.chdir(cwd)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(names, repeat):
+    results = {}
+    for name in names:
+        func, requirement = stages[name]
+        if requirement is not None and not requirement():
+            print("%-30s skipped (%s)" % (name, requirement.__name__))
+            continue
+        results[name] = time_stage(func, repeat)
+        print("%-30s %8.3f s" % (name, results[name]), flush=True)
+    return results
+
+## ----------------------
+##        checks
+## ----------------------
+
+# NOTE: the optimized paths must give the results of the plain ones; each
+#   check returns a list of mismatches
+check_tolerance = 1e-9
+
+def close(a, b):
+    return a == b or abs(a - b) <= check_tolerance * max(1.0, abs(a), abs(b))
+
+def skimage_values(ref, img):
+    x = main.image_store.load(ref)
+    y = main.image_store.load(img)
+    return {"MSE":  main.skimage.metrics.mean_squared_error(x, y),
+            "PSNR": main.skimage.metrics.peak_signal_noise_ratio(x, y),
+            "SSIM": main.skimage.metrics.structural_similarity(x, y, channel_axis=2)}
+
+def mismatches(label, expected, got):
+    return ["%s %s: expected %r, got %r" % (label, name, expected[name], got[name])
+            for name in expected if not close(expected[name], got[name])]
+
+def check_metrics_batch():
+    errors = []
+    for img, values in zip(iters, main.get_similarity_values_batch(ref, iters)):
+        errors += mismatches(Path(img).name, skimage_values(ref, img), values)
+    return errors
+
+def check_metrics_tiled():
+    # a tile size that divides neither side, so the border tiles are partial
+    errors = []
+    for img in iters[:2]:
+        errors += mismatches(Path(img).name, skimage_values(ref, img),
+                             main.tiled_similarity_values(ref, img, tile_size=97, workers=2))
+    return errors
+
+def brute_force_boxes(error, sizes, ref_crop, avoid):
+    # place_boxes by trying every window: same visible area, same grid to
+    #   pixel conversion, boxes may touch but not overlap
+    h, w   = error.shape
+    top    = main.ceil(ref_crop[3] / 10 * h)
+    bottom = main.floor((10 - ref_crop[1]) / 10 * h)
+    left   = main.ceil(ref_crop[0] / 10 * w)
+    right  = main.floor((10 - ref_crop[2]) / 10 * w)
+
+    taken = []
+    for x, y, size in avoid:
+        px = round(size / 10 * w)
+        taken.append((h - round(y / 10 * h) - px, round(x / 10 * w), px))
+
+    boxes = []
+    for size in sizes:
+        px   = round(size / 10 * w)
+        best = None
+        for row in range(top, bottom - px + 1):
+            for col in range(left, right - px + 1):
+                if any(row < r + p and r < row + px and col < c + p and c < col + px for r, c, p in taken):
+                    continue
+                score = float(error[row:row+px, col:col+px].sum())
+                if best is None or score > best[0]:
+                    best = (score, row, col)
+        taken.append((best[1], best[2], px))
+        boxes.append((best[2] / w * 10, (h - (best[1] + px)) / h * 10, size))
+    return boxes
+
+def check_boxes():
+    rng    = main.np.random.default_rng(0)
+    errors = []
+    for trial in range(5):
+        error    = rng.random((40, 60))
+        ref_crop = (0, 0, 0, 0) if trial == 0 else tuple(rng.integers(0, 3, 4) / 2)
+        avoid    = () if trial < 2 else ((5.0, 5.0, 1.0),)
+        sizes    = (1.5, 1, 0.5)
+        expected = brute_force_boxes(error, sizes, ref_crop, avoid)
+        got      = main.place_boxes(error, sizes, ref_crop, avoid)
+        for b, (e, g) in enumerate(zip(expected, got)):
+            if not all(close(a, c) for a, c in zip(e, g)):
+                errors.append("trial %d box %d: expected %r, got %r" % (trial, b, e, g))
+    return errors
+
+def check_flip_inprocess():
+    # the in-process backend re-implements flip.py, maps may differ by one
+    #   magma step from float rounding, stats only in the last digits
+    errors = []
+    for img in iters[:2]:
+        maps, stats = [], []
+        for backend in ("subprocess", "inprocess"):
+            main.flip_backend = backend
+            try:
+                flip_png, flip_stats = main.create_flip_image_and_stats(ref, img)
+            finally:
+                main.flip_backend = "subprocess"
+            maps.append(main.np.asarray(main.Image.open(flip_png).convert("RGB"), dtype=main.np.int16))
+            stats.append(flip_stats)
+
+        differing = (abs(maps[0] - maps[1]).max(axis=2) > 8).mean()
+        if differing > 0.001:
+            errors.append("%s map: %.2f%% of the pixels differ" % (Path(img).name, differing * 100))
+        for name, value in stats[0].items():
+            if abs(value - stats[1][name]) > 1e-4 * max(1.0, abs(value)):
+                errors.append("%s %s: flip.py %r, in-process %r" % (Path(img).name, name, value, stats[1][name]))
+    return errors
+
+# name -> (function, requirement)
+checks = {
+    "metrics_batch":  (check_metrics_batch,  None),
+    "metrics_tiled":  (check_metrics_tiled,  None),
+    "boxes":          (check_boxes,          None),
+    "flip_inprocess": (check_flip_inprocess, have_flip),
+}
+
+def run_checks(names):
+    failed = []
+    for name in names:
+        func, requirement = checks[name]
+        if requirement is not None and not requirement():
+            print("%-30s skipped (%s)" % (name, requirement.__name__))
+            continue
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                reset_caches()
+                errors = func()
+            finally:
+                os.chdir(cwd)
+        print("%-30s %s" % (name, "FAILED" if errors else "ok"), flush=True)
+        for error in errors:
+            print("    " + error)
+        if errors:
+            failed.append(name)
+    return failed
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        ratio = seconds / baseline[name] if baseline[name] > 0 else float("inf")
+        flag  = ratio > 1 + threshold
+        print("%-30s %8.3f s  baseline %8.3f s  %+6.1f%%%s" %
+              (name, seconds, baseline[name], (ratio - 1) * 100, "  REGRESSION" if flag else ""))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the figure pipeline.")
+    parser.add_argument("stages", nargs="*", default=None, help="stages (or checks) to run (default: all)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="repetitions, the fastest one counts")
+    parser.add_argument("--save", metavar="JSON", help="write the timings as a new baseline")
+    parser.add_argument("--baseline", metavar="JSON", help="compare against a stored baseline")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown before flagging (0.1 = 10%%)")
+    parser.add_argument("--check", action="store_true", help="run the equivalence checks instead of timing")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(1 if run_checks(args.stages or list(checks)) else 0)
+
+    results = run(args.stages or list(stages), args.repeat)
+
+    if args.save:
+        with open(args.save, "w") as out_file:
+            json.dump(results, out_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as in_file:
+            if compare(results, json.load(in_file), args.threshold):
+                sys.exit(1)
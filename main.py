@@ -27,14 +27,70 @@
 
 
 from pathlib import Path
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import argparse
+import asyncio
+import subprocess
+import shutil
+from threading import Lock
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import hashlib
+import time
+import io
+import re
+import sqlite3
+import json
+import csv
 import sys
 import os
+import importlib
+import inspect
+
+from decimal import Decimal
+from math import log, log10, floor, ceil, pi
+
+class LazyModule:
+    """Stands in for a module until one of its attributes is used. Keeps
+    numpy, PIL and the scikit-image/scipy stack out of runs that only emit
+    TeX or find everything cached."""
+
+    def __init__(self, name, *submodules):
+        self._name       = name
+        self._submodules = submodules
+        self._module     = None
+
+    # NOTE: one lock for all of them, a worker thread importing numpy while
+    #   another imports skimage (which imports numpy) can otherwise see a
+    #   partially initialized module
+    _lock = threading.RLock()
+
+    def _load(self):
+        if self._module is None:
+            with LazyModule._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name)
+                    for sub in self._submodules:
+                        importlib.import_module(self._name + "." + sub)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+Image   = LazyModule("PIL.Image")
+np      = LazyModule("numpy")
+skimage = LazyModule("skimage", "io", "metrics", "util")
+
+def uniform_filter(*args, **kwargs):
+    with LazyModule._lock:
+        from scipy.ndimage import uniform_filter
+    return uniform_filter(*args, **kwargs)
 
-from math import log10, floor
 def round_sig(x, sig=3):
-    if x == 0:
-        return 0
+    if x == 0 or x != x or abs(x) == float("inf"):
+        return x
     return round(x, sig-int(floor(log10(abs(x))))-1)
 
 def lst_or_tpl(obj):
@@ -55,19 +111,606 @@ def remap(a, x, b, c, d):
 def flatten(ls):
     return (item for sublist in ls for item in sublist)
 
-import skimage
-import skimage.io
-import skimage.metrics
+_file_hashes = {}
+def file_hash(path):
+    st  = os.stat(path)
+    key = (str(Path(path).resolve()), st.st_mtime_ns, st.st_size)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, "rb") as in_file:
+            for chunk in iter(lambda: in_file.read(1 << 20), b""):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+def content_key(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+## ----------------------
+##        tracing
+## ----------------------
+
+trace_events = []
+_trace_start = time.perf_counter()
+_trace_lock  = Lock()
+
+@contextmanager
+def trace_span(name, **args):
+    """Records how long the body takes as a trace event. The yielded dict
+    ends up as the event's args, so the body can add cache hits, sizes or
+    exit codes to it."""
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        end = time.perf_counter()
+        with _trace_lock:
+            trace_events.append({"name": name, "ph": "X",
+                                 "ts":   (start - _trace_start) * 1e6,
+                                 "dur":  (end - start) * 1e6,
+                                 "pid":  os.getpid(), "tid": threading.get_ident(),
+                                 "args": {k: v if isinstance(v, (int, float, bool)) or v is None else str(v)
+                                          for k, v in args.items()}})
+
+def write_chrome_trace(file_name):
+    # NOTE: load in chrome://tracing or https://ui.perfetto.dev
+    with _trace_lock:
+        events = list(trace_events)
+    with open(file_name, "w") as out_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out_file)
+
+def print_trace_summary(slowest=5):
+    with _trace_lock:
+        events = list(trace_events)
+    if not events:
+        return
+
+    stages = {}
+    for e in events:
+        stage = stages.setdefault(e["name"], {"count": 0, "total": 0.0, "max": 0.0, "hit": 0, "miss": 0, "failed": 0})
+        stage["count"] += 1
+        stage["total"] += e["dur"] / 1e6
+        stage["max"]    = max(stage["max"], e["dur"] / 1e6)
+        if e["args"].get("cache") in ("hit", "miss"):
+            stage[e["args"]["cache"]] += 1
+        if e["args"].get("status") not in (None, 0):
+            stage["failed"] += 1
+
+    print()
+    print("%-16s %6s %10s %10s %10s %6s %6s %6s" % ("stage", "count", "total s", "mean s", "max s", "hit", "miss", "failed"))
+    for name, st in sorted(stages.items(), key=lambda kv: -kv[1]["total"]):
+        print("%-16s %6d %10.3f %10.3f %10.3f %6d %6d %6d" %
+              (name, st["count"], st["total"], st["total"] / st["count"], st["max"], st["hit"], st["miss"], st["failed"]))
+
+    print()
+    print("slowest:")
+    for e in sorted(events, key=lambda e: -e["dur"])[:slowest]:
+        what = e["args"].get("file") or e["args"].get("path") or e["args"].get("img") or ""
+        print("  %10.3f s  %-12s %s" % (e["dur"] / 1e6, e["name"], what))
+
+## ----------------------
+##      subprocesses
+## ----------------------
+
+subprocess_limit    = os.cpu_count()
+subprocess_timeouts = {"flip": 600, "pdflatex": 300}
+job_log_dir         = ".logs/"
+
+class Job:
+    """One external command. `owner` names whoever asked for it (a figure, a
+    FLIP pair) so failures can be reported back to it."""
+
+    def __init__(self, kind, name, cmd, cwd=None, env=None, timeout=None, owner=None):
+        self.kind    = kind
+        self.name    = name
+        self.cmd     = [str(c) for c in cmd]
+        self.cwd     = cwd
+        self.env     = env
+        self.timeout = timeout if timeout is not None else subprocess_timeouts.get(kind)
+        self.owner   = owner or name
+        self.status  = None
+        self.log     = str(Path(job_log_dir)/(re.sub(r"[^\w.+-]", "_", kind + "-" + name) + ".log"))
+
+class JobFailed(Exception):
+    def __init__(self, job):
+        self.job = job
+        reason   = "timed out after %ss" % job.timeout if job.status == 124 else "exit status %s" % job.status
+        tail     = ""
+        if Path(job.log).exists():
+            with open(job.log, "r", errors="replace") as in_file:
+                tail = "".join(in_file.readlines()[-10:])
+        super().__init__("%s for %s failed (%s), see %s\n%s" % (job.kind, job.owner, reason, job.log, tail))
+
+# NOTE: one limiter for the whole process, every run_jobs call (and every
+#   worker thread making one) takes its slots from here, so FLIP and pdflatex
+#   together never run more than subprocess_limit commands at once
+_subprocess_slots   = threading.Condition()
+_subprocess_running = 0
+
+def _acquire_subprocess_slot():
+    global _subprocess_running
+    with _subprocess_slots:
+        _subprocess_slots.wait_for(lambda: _subprocess_running < max(1, subprocess_limit))
+        _subprocess_running += 1
+
+def _release_subprocess_slot():
+    global _subprocess_running
+    with _subprocess_slots:
+        _subprocess_running -= 1
+        _subprocess_slots.notify_all()
+
+async def _run_job(job, slots):
+    async with slots:
+        await asyncio.to_thread(_acquire_subprocess_slot)
+        try:
+            await _run_job_command(job)
+        finally:
+            _release_subprocess_slot()
+    return job
+
+async def _run_job_command(job):
+    with trace_span(job.kind, file=job.name, cache="miss") as span:
+        Path(job.log).parent.mkdir(parents=True, exist_ok=True)
+        with open(job.log, "wb") as log:
+            try:
+                proc = await asyncio.create_subprocess_exec(*job.cmd, cwd=job.cwd, env=job.env,
+                                                            stdout=log, stderr=asyncio.subprocess.STDOUT)
+            except FileNotFoundError:
+                log.write(("command not found: " + job.cmd[0] + "\n").encode())
+                job.status = 127
+            else:
+                try:
+                    job.status = await asyncio.wait_for(proc.wait(), job.timeout)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+                    job.status = 124
+        span["status"] = job.status
+
+def run_jobs(jobs, limit=None):
+    """Runs the jobs as subprocesses, at most `limit` of them at once and never
+    more than subprocess_limit across all threads, each with its output
+    captured to job.log and killed after job.timeout seconds. Sets and
+    returns job.status (124 on timeout, 127 if the command is missing)."""
+    async def run_all():
+        slots = asyncio.Semaphore(limit or len(jobs))
+        return await asyncio.gather(*(_run_job(job, slots) for job in jobs))
+
+    if not jobs:
+        return []
+    return asyncio.run(run_all())
+
+def run_job(job):
+    return run_jobs([job])[0]
+
+def check_job(job):
+    if job.status != 0:
+        raise JobFailed(job)
+    return job
+
+# NOTE: with tex_only the figures are laid out from the image headers alone:
+#   no pixels are decoded, insets are trimmed by LaTeX, FLIP maps are only
+#   referenced by their cache name and metrics come from the metrics database
+#   or show up as "--"
+tex_only = False
+
+image_store_budget = 2 << 30
+
+class ImageStore:
+    """Decodes each image file at most once per run and hands out read-only
+    arrays. Least recently used images are dropped once the decoded pixels
+    exceed `budget` bytes."""
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.images = OrderedDict()
+        self.sizes  = {}
+        self.decoding = {}
+        self.bytes  = 0
+        self.lock   = Lock()
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return (str(Path(path).resolve()), st.st_mtime_ns, st.st_size)
+
+    def size(self, path):
+        # NOTE: PIL only parses the header until the pixels are accessed
+        key = self._key(path)
+        if key not in self.sizes:
+            with Image.open(path) as image:
+                self.sizes[key] = image.size
+        return self.sizes[key]
+
+    @staticmethod
+    def _pixels(image):
+        # NOTE: the conversions skimage.io.imread does, so a palette PNG gives
+        #   its colours and not the palette indices
+        if image.mode == "P":
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        elif image.mode == "1":
+            image = image.convert("L")
+        elif image.mode in ("LA", "PA", "La", "RGBa"):
+            image = image.convert("RGBA")
+        elif image.mode in ("CMYK", "YCbCr", "LAB", "HSV"):
+            image = image.convert("RGB")
+        elif image.mode.startswith("I;16"):
+            return np.asarray(image).astype(np.uint16)
+        return np.asarray(image)
+
+    def load(self, path):
+        key = self._key(path)
+        with trace_span("decode", path=path) as span:
+            with self.lock:
+                if key in self.images:
+                    self.images.move_to_end(key)
+                    span["cache"] = "hit"
+                    return self.images[key]
+                # NOTE: tasks decode on demand, the ones asking for an image
+                #   another task is already decoding wait for that one
+                decoding = self.decoding.get(key)
+                if decoding is None:
+                    self.decoding[key] = Future()
+
+            if decoding is not None:
+                span["cache"]  = "hit"
+                span["waited"] = True
+                return decoding.result()
+
+            span["cache"] = "miss"
+            try:
+                with Image.open(path) as image:
+                    array = self._pixels(image)
+            except Exception as error:
+                with self.lock:
+                    self.decoding.pop(key).set_exception(error)
+                raise
+            array.flags.writeable = False
+            span["bytes"] = array.nbytes
+
+            with self.lock:
+                self.decoding.pop(key).set_result(array)
+                if key not in self.images:
+                    self.images[key] = array
+                    self.bytes      += array.nbytes
+                budget = self.budget if self.budget is not None else image_store_budget
+                while self.bytes > budget and len(self.images) > 1:
+                    _, evicted  = self.images.popitem(last=False)
+                    self.bytes -= evicted.nbytes
+                return self.images.get(key, array)
+
+    def crop(self, path, trim):
+        # latex crop: left, bottom, right, top in fractions of the image
+        array = self.load(path)
+        h, w  = array.shape[:2]
+        return array[round(h*trim[3]):round(h - h*trim[1]), round(w*trim[0]):round(w - w*trim[2])]
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.sizes.clear()
+            self.bytes = 0
+
+image_store = ImageStore()
+
+def load_image(img):
+    return image_store.load(img) if isinstance(img, (str, Path)) else np.asarray(img)
+
 
 def get_similarity_values(ref, img):
-    sk_ref     = skimage.io.imread(ref)
-    sk_img     = skimage.io.imread(img)
+    if metrics_preview:
+        return preview_similarity_values(ref, img)
+    if metrics_engine == "tiled":
+        return tiled_similarity_values(ref, img)
+    sk_ref     = load_image(ref)
+    sk_img     = load_image(img)
     mse        = skimage.metrics.mean_squared_error(sk_ref, sk_img)
     psnr       = skimage.metrics.peak_signal_noise_ratio(sk_ref, sk_img)
     ssim       = skimage.metrics.structural_similarity(sk_ref, sk_img, channel_axis=2)
 
     return {"MSE": mse, "PSNR": psnr, "SSIM": ssim}
 
+ssim_win_size      = 7
+
+# NOTE: candidates filtered together in one stack. Each one costs about six
+#   full size float64 copies of the image, and the speed comes from reusing
+#   the reference moments rather than from stacking, so one at a time
+metrics_batch_size = 1
+
+# NOTE: "batch" filters whole candidates against a prepared reference,
+#   "tiled" goes tile by tile with bounded memory. Both give the
+#   skimage values, so they share the cached results
+metrics_engine     = "batch"
+
+def default_data_range(image):
+    # NOTE: like skimage for integer images; float data is taken to be in [0, 1]
+    if np.issubdtype(image.dtype, np.floating):
+        return 1.0
+    dmin, dmax = skimage.util.dtype_limits(image, clip_negative=False)
+    return dmax - dmin
+
+def ssim_from_moments(ux, uy, vx, vy, vxy, data_range, k1=0.01, k2=0.03):
+    c1 = (k1 * data_range) ** 2
+    c2 = (k2 * data_range) ** 2
+    return ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux ** 2 + uy ** 2 + c1) * (vx + vy + c2))
+
+class ReferenceMetrics:
+    """MSE/PSNR/SSIM of many candidates against one reference. Matches
+    skimage.metrics with its default (uniform 7x7 window) SSIM, but decodes the
+    reference and computes its local mean and variance only once."""
+
+    def __init__(self, ref):
+        ref_image       = load_image(ref)
+        self.data_range = default_data_range(ref_image)
+        self.ref        = ref_image.astype(np.float64)
+        self.size       = self._window(self.ref.ndim)
+        self.cov_norm   = ssim_win_size**2 / (ssim_win_size**2 - 1)
+
+        self.ux  = uniform_filter(self.ref, size=self.size)
+        self.vx  = self.cov_norm * (uniform_filter(self.ref * self.ref, size=self.size) - self.ux * self.ux)
+
+    @staticmethod
+    def _window(ndim, stacked=False):
+        # NOTE: filter over the two spatial axes only, channels and the
+        #   candidate axis are left alone (size 1)
+        size = [ssim_win_size, ssim_win_size] + [1] * (ndim - 2)
+        return tuple([1] + size) if stacked else tuple(size)
+
+    def _metrics(self, stack):
+        stack = stack.astype(np.float64)
+        size  = self._window(self.ref.ndim, stacked=True)
+
+        mse  = ((stack - self.ref) ** 2).reshape(len(stack), -1).mean(axis=1)
+        with np.errstate(divide="ignore"):
+            psnr = 10 * np.log10(self.data_range ** 2 / mse)
+
+        uy  = uniform_filter(stack, size=size)
+        vy  = self.cov_norm * (uniform_filter(stack * stack, size=size) - uy * uy)
+        vxy = self.cov_norm * (uniform_filter(stack * self.ref, size=size) - self.ux * uy)
+
+        s    = ssim_from_moments(self.ux, uy, self.vx, vy, vxy, self.data_range)
+        pad  = (ssim_win_size - 1) // 2
+        ssim = s[:, pad:-pad, pad:-pad].reshape(len(stack), -1).mean(axis=1, dtype=np.float64)
+
+        return [{"MSE": float(m), "PSNR": float(p), "SSIM": float(q)} for m, p, q in zip(mse, psnr, ssim)]
+
+    def compare(self, imgs):
+        results = []
+        for start in range(0, len(imgs), metrics_batch_size):
+            chunk = [load_image(i) for i in imgs[start:start+metrics_batch_size]]
+            with trace_span("metrics", candidates=len(chunk), bytes=sum(c.nbytes for c in chunk)):
+                results.extend(self._metrics(np.stack(chunk)))
+        return results
+
+_reference_metrics      = {}
+_reference_metrics_lock = Lock()
+def reference_metrics(ref):
+    # NOTE: like flip_reference, a long running process (watch mode) keeps the
+    #   prepared reference of the last few figures around
+    key = file_hash(ref)
+    with _reference_metrics_lock:
+        if key not in _reference_metrics:
+            if len(_reference_metrics) >= 4:
+                del _reference_metrics[next(iter(_reference_metrics))]
+            _reference_metrics[key] = ReferenceMetrics(ref)
+        return _reference_metrics[key]
+
+def get_similarity_values_batch(ref, imgs):
+    if metrics_preview:
+        return [preview_similarity_values(ref, img) for img in imgs]
+    if metrics_engine == "tiled":
+        return [tiled_similarity_values(ref, img) for img in imgs]
+    if isinstance(ref, (str, Path)):
+        return reference_metrics(ref).compare(list(imgs))
+    return ReferenceMetrics(ref).compare(list(imgs))
+
+def box_similarity_values(ref, imgs, boxes, ref_crop=(0, 0, 0, 0)):
+    """MSE/PSNR/SSIM of each candidate inside each grid space box (x, y,
+    size), computed on exactly the pixels the inset shows. Returns one list
+    per candidate with one dict per box.
+
+    Boxes are given in the full image's grid, like everywhere else; ref_crop
+    only changes where do_one_line draws them on the reference, so it is
+    checked here but doesn't move the region."""
+    if tex_only:
+        nan = float("nan")
+        return [[{"MSE": nan, "PSNR": nan, "SSIM": nan} for _ in boxes] for _ in imgs]
+
+    res    = image_store.size(ref)
+    aspect = res[0] / res[1]
+
+    results = [[] for _ in imgs]
+    for box in boxes:
+        if any(ref_crop) and not (ref_crop[0] <= box[0] and box[0] + box[2] <= 10 - ref_crop[2] and
+                                  ref_crop[1] <= box[1] and box[1] + box[2]*aspect <= 10 - ref_crop[3]):
+            raise Exception("Box " + str(tuple(box)) + " is not inside the visible part of the reference")
+
+        trim       = calc_box_dim(box, aspect)
+        ref_region = image_store.crop(ref, trim)
+        if min(ref_region.shape[:2]) < ssim_win_size:
+            raise Exception("Box " + str(tuple(box)) + " covers only " + "x".join(map(str, ref_region.shape[1::-1])) +
+                            " pixels, SSIM needs at least " + str(ssim_win_size) + "x" + str(ssim_win_size))
+        with trace_span("metrics.box", path=ref, box=tuple(box), candidates=len(imgs)):
+            values = ReferenceMetrics(ref_region).compare([image_store.crop(img, trim) for img in imgs])
+        for result, value in zip(results, values):
+            result.append(value)
+
+    return results
+
+# NOTE: the peak is one tile's working set per worker, so the workers are
+#   derived from metrics_tile_budget (bytes) instead of the core count; a
+#   budget too small for one full tile shrinks the tile. metrics_tile_workers
+#   set to a number overrides the budget
+metrics_tile_size    = 1024
+metrics_tile_budget  = 1 << 30
+metrics_tile_workers = None
+metrics_tile_copies  = 12  # float64 tile sized arrays alive in do_tile
+
+def tile_plan(channels, tile_size=None, workers=None):
+    """(tile_size, workers) that keep the tiled metrics within
+    metrics_tile_budget for images with `channels` channels."""
+    tile_size = tile_size or metrics_tile_size
+    pad       = (ssim_win_size - 1) // 2
+    def cost(size):
+        return metrics_tile_copies * 8 * channels * (size + 2 * pad) ** 2
+
+    if workers or metrics_tile_workers:
+        return tile_size, workers or metrics_tile_workers
+    while tile_size > 64 and cost(tile_size) > metrics_tile_budget:
+        tile_size //= 2
+    return tile_size, max(1, min(os.cpu_count() or 1, metrics_tile_budget // cost(tile_size)))
+
+def open_image_array(path):
+    # NOTE: .npy stays memory mapped, only the tiles that are worked on are
+    #   ever read
+    if str(path).endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    return load_image(path)
+
+def tiled_similarity_values(ref, img, tile_size=None, workers=None, data_range=None):
+    """Same MSE/PSNR/SSIM as get_similarity_values, but computed tile by tile
+    so the working memory (roughly a dozen float64 copies of a
+    (tile_size + 6)^2 tile per worker) stays within metrics_tile_budget, no
+    matter the image size or the core count. Takes image files or memory mapped .npy arrays; only for .npy is the
+    peak bounded, image files are still decoded whole (through image_store)."""
+    x = open_image_array(ref)
+    y = open_image_array(img)
+    if x.shape != y.shape:
+        raise Exception("Reference and candidate need to have the same shape")
+
+    tile_size, workers = tile_plan(x.shape[2] if x.ndim > 2 else 1, tile_size, workers)
+    data_range = data_range or default_data_range(x)
+    pad        = (ssim_win_size - 1) // 2
+    size       = [ssim_win_size, ssim_win_size] + [1] * (x.ndim - 2)
+    h, w       = x.shape[:2]
+    cov_norm   = ssim_win_size**2 / (ssim_win_size**2 - 1)
+
+    def do_tile(origin):
+        y0, x0 = origin
+        y1, x1 = min(y0 + tile_size, h), min(x0 + tile_size, w)
+
+        # NOTE: a halo of `pad` pixels makes the filtered values inside the
+        #   tile exact; at the image border the filter's own reflect padding
+        #   is the same one the full image would get
+        hy0, hx0 = max(y0 - pad, 0), max(x0 - pad, 0)
+        hy1, hx1 = min(y1 + pad, h), min(x1 + pad, w)
+        a = np.asarray(x[hy0:hy1, hx0:hx1], dtype=np.float64)
+        b = np.asarray(y[hy0:hy1, hx0:hx1], dtype=np.float64)
+
+        inner = (slice(y0 - hy0, y1 - hy0), slice(x0 - hx0, x1 - hx0))
+        sse   = ((a[inner] - b[inner]) ** 2).sum()
+
+        ua, ub = uniform_filter(a, size=size), uniform_filter(b, size=size)
+        va  = cov_norm * (uniform_filter(a * a, size=size) - ua * ua)
+        vb  = cov_norm * (uniform_filter(b * b, size=size) - ub * ub)
+        vab = cov_norm * (uniform_filter(a * b, size=size) - ua * ub)
+        s   = ssim_from_moments(ua, ub, va, vb, vab, data_range)
+
+        # only pixels at least `pad` away from the image border count for SSIM
+        sy0, sy1 = max(y0, pad) - hy0, min(y1, h - pad) - hy0
+        sx0, sx1 = max(x0, pad) - hx0, min(x1, w - pad) - hx0
+        if sy1 <= sy0 or sx1 <= sx0:
+            return sse, 0.0, 0
+        counted = s[sy0:sy1, sx0:sx1]
+        return sse, counted.sum(), counted.size
+
+    origins = [(ty, tx) for ty in range(0, h, tile_size) for tx in range(0, w, tile_size)]
+    with trace_span("metrics.tiled", path=img, tiles=len(origins), tile_size=tile_size, workers=workers):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(do_tile, origins))
+
+    mse = sum(p[0] for p in parts) / x.size
+    with np.errstate(divide="ignore"):
+        psnr = 10 * np.log10(data_range ** 2 / mse)
+    ssim = sum(p[1] for p in parts) / sum(p[2] for p in parts)
+
+    return {"MSE": float(mse), "PSNR": float(psnr), "SSIM": float(ssim)}
+
+## ----------------------
+##    preview metrics
+## ----------------------
+
+# NOTE: preview builds estimate the metrics from a sample instead of every
+#   pixel and put a "<name> err" entry (half width of the 95% interval) next
+#   to each estimated value. FLIP maps come from a downsampled pyramid level.
+#   Everything is cached apart from the exact results, final builds never
+#   see any of it
+metrics_preview       = False
+preview_stratum       = 16      # one MSE and one SSIM sample per 16x16 block
+preview_flip_tile     = 128
+preview_flip_fraction = 1 / 32  # of the full resolution FLIP tiles
+preview_flip_level    = 2       # FLIP map at 1/4 resolution
+preview_seed          = 0
+preview_z             = 1.96
+preview_note          = "PREVIEW: sampled metrics and FLIP, %s 95%% interval"
+
+def preview_version():
+    return content_key("preview", FLIP_INPROCESS_VERSION, preview_stratum, preview_flip_tile, preview_flip_fraction,
+                       preview_flip_level, preview_seed)[:12]
+
+def stratified_pixels(h, w, stratum, rng, margin=0):
+    """One random pixel in every stratum x stratum block of the image without
+    its margin. Returns ys, xs and each sample's block area as its weight."""
+    gy, gx = np.meshgrid(np.arange(margin, h - margin, stratum), np.arange(margin, w - margin, stratum), indexing="ij")
+    hy = np.minimum(stratum, h - margin - gy)
+    hx = np.minimum(stratum, w - margin - gx)
+    ys = gy + (rng.random(gy.shape) * hy).astype(np.intp)
+    xs = gx + (rng.random(gx.shape) * hx).astype(np.intp)
+    return ys.ravel(), xs.ravel(), (hy * hx).ravel().astype(np.float64)
+
+def weighted_mean_and_error(values, weights):
+    # NOTE: the standard error of independent draws; the stratification only
+    #   lowers the real one, so the interval errs on the wide side
+    total = np.sum(weights)
+    mean  = np.sum(weights * values) / total
+    error = np.sqrt(np.sum((weights * (values - mean)) ** 2)) / total
+    return float(mean), preview_z * float(error)
+
+def preview_similarity_values(ref, img):
+    """MSE/PSNR/SSIM like get_similarity_values, estimated from a stratified
+    sample of pixels (SSIM: of 7x7 windows), with error bars."""
+    x = load_image(ref)
+    y = load_image(img)
+    if x.shape != y.shape:
+        raise Exception("Input images must have the same dimensions.")
+    data_range = default_data_range(x)
+    h, w       = x.shape[:2]
+
+    # NOTE: every candidate of a reference is sampled at the same pixels
+    rng = np.random.default_rng(preview_seed)
+
+    ys, xs, weights = stratified_pixels(h, w, preview_stratum, rng)
+    se        = (x[ys, xs].astype(np.float64) - y[ys, xs]) ** 2
+    mse, mse_err = weighted_mean_and_error(se.reshape(len(ys), -1).mean(axis=1), weights)
+
+    pad             = (ssim_win_size - 1) // 2
+    ys, xs, weights = stratified_pixels(h, w, preview_stratum, rng, margin=pad)
+    offsets  = np.arange(-pad, pad + 1)
+    wy       = ys[:, None, None] + offsets[None, :, None]
+    wx       = xs[:, None, None] + offsets[None, None, :]
+    px       = x[wy, wx].astype(np.float64)
+    py       = y[wy, wx].astype(np.float64)
+    cov_norm = ssim_win_size**2 / (ssim_win_size**2 - 1)
+    ux, uy   = px.mean(axis=(1, 2)), py.mean(axis=(1, 2))
+    vx       = cov_norm * ((px * px).mean(axis=(1, 2)) - ux * ux)
+    vy       = cov_norm * ((py * py).mean(axis=(1, 2)) - uy * uy)
+    vxy      = cov_norm * ((px * py).mean(axis=(1, 2)) - ux * uy)
+    s        = ssim_from_moments(ux, uy, vx, vy, vxy, data_range).reshape(len(ys), -1).mean(axis=1)
+    ssim, ssim_err = weighted_mean_and_error(s, weights)
+
+    if mse > 0:
+        psnr     = 10 * log10(data_range ** 2 / mse)
+        psnr_err = 10 / log(10) * mse_err / mse
+    else:
+        psnr, psnr_err = float("inf"), 0.0
+
+    return {"MSE": mse, "PSNR": psnr, "SSIM": ssim,
+            "MSE err": mse_err, "PSNR err": psnr_err, "SSIM err": ssim_err}
+
 def read_flip_stats(file_path):
     stats = {}
     with open(file_path, "r") as in_file:
@@ -78,70 +721,584 @@ def read_flip_stats(file_path):
 
     return stats
 
-flipped_images = 0
-def create_flip_image(ref, img):
-    global flipped_images
-
-    flipped_images += 1
-    base_path = ".flip/"
-    Path(base_path).mkdir(parents=True, exist_ok=True)
-
+def write_flip_stats(stats, file_path):
+    with open(file_path, "w") as out_file:
+        for name, value in stats.items():
+            print(name[len("Flip "):]+":", value, file=out_file)
+
+# NOTE: "subprocess" runs flip/python/flip.py per pair, "inprocess" imports the
+#   submodule once and reuses the prepared reference for every candidate
+flip_backend           = "subprocess"
+flip_pixels_per_degree = 0.7 * (3840 / 0.7) * pi / 180
+flip_settings          = ()
+flip_cache_dir         = ".flip/"
+FLIP_INPROCESS_VERSION = 2  # bump when the in-process maps or stats change
+
+def flip_cache_key(ref, img):
+    if metrics_preview:
+        return content_key("flip-preview", file_hash(ref), file_hash(img), flip_pixels_per_degree, preview_version())
+    settings = flip_settings if flip_backend == "subprocess" else (flip_pixels_per_degree, FLIP_INPROCESS_VERSION)
+    return content_key("flip", flip_backend, file_hash(ref), file_hash(img), *settings)
+
+_flip_api = None
+def load_flip_api():
+    global _flip_api
+    if _flip_api is None:
+        flip_dir = str((Path(__file__).parent/Path("./flip/python")).resolve())
+        if flip_dir not in sys.path:
+            sys.path.insert(0, flip_dir)
+        import flip_api
+        import data as flip_data
+        _flip_api = (flip_api, flip_data)
+    return _flip_api
+
+def load_flip_array(path):
+    # FLIP works on channel-first sRGB in [0, 1]
+    image = image_store.load(path)
+    if image.ndim == 2:
+        image = np.stack((image,)*3, axis=-1)
+    image = np.asarray(image[..., :3], dtype=np.float32) / 255
+    return image.transpose(2, 0, 1)
+
+def _weighted_percentile(values, percentile):
+    # NOTE: as flip.py computes it, every error is weighted by itself and
+    #   sits at the middle of its share of the cumulative sum
+    values  = np.sort(values).astype(np.float64)
+    weights = np.cumsum(values)
+    if weights[-1] == 0:
+        return 0.0
+    return float(np.interp(percentile / 100 * weights[-1], weights - 0.5 * values, values))
+
+def flip_stats_from_map(error_map):
+    values = error_map.ravel()
+    return {"Flip Mean":                  float(values.mean()),
+            "Flip Weighted median":       _weighted_percentile(values, 50),
+            "Flip 1st weighted quartile": _weighted_percentile(values, 25),
+            "Flip 3rd weighted quartile": _weighted_percentile(values, 75),
+            "Flip Min":                   float(values.min()),
+            "Flip Max":                   float(values.max())}
+
+def save_flip_image(error_map, path):
+    _, flip_data = load_flip_api()
+    magma = np.asarray(flip_data.get_magma_map())
+    index = np.floor(np.clip(error_map, 0, 1) * 255).astype(np.uint8)
+    save_intermediate(Image.fromarray((magma[index] * 255 + 0.5).astype(np.uint8)), path, lossy=False)
+
+class FlipReference:
+    """LDR-FLIP with the reference side (colour transform, spatial filtering,
+    feature detection) computed once and reused for every candidate. With
+    ref=None only the filters are set up, for evaluate_region()."""
+
+    qc, qf, pc, pt = 0.7, 0.5, 0.4, 0.95
+
+    def __init__(self, ref, pixels_per_degree=None):
+        api, _   = load_flip_api()
+        self.ppd = pixels_per_degree or flip_pixels_per_degree
+
+        s_a,  radius_a  = api.generate_spatial_filter(self.ppd, "A")
+        s_rg, radius_rg = api.generate_spatial_filter(self.ppd, "RG")
+        s_by, radius_by = api.generate_spatial_filter(self.ppd, "BY")
+        self.filters = (s_a, s_rg, s_by, max(radius_a, radius_rg, radius_by))
+
+        green = api.hunt_adjustment(api.color_space_transform(np.array([[[0.0]], [[1.0]], [[0.0]]]), "linrgb2lab"))
+        blue  = api.hunt_adjustment(api.color_space_transform(np.array([[[0.0]], [[0.0]], [[1.0]]]), "linrgb2lab"))
+        self.cmax = np.power(api.hyab(green, blue), self.qc)
+
+        if ref is not None:
+            self.preprocessed, self.edges, self.points = self._prepare(load_flip_array(ref))
+
+    def _prepare(self, image):
+        api, _ = load_flip_api()
+        ycxcz  = api.color_space_transform(image, "srgb2ycxcz")
+        preprocessed = api.hunt_adjustment(api.color_space_transform(api.spatial_filter(ycxcz, *self.filters), "linrgb2lab"))
+
+        y      = (ycxcz[0:1, :, :] + 16) / 116
+        edges  = np.linalg.norm(api.feature_detection(y, self.ppd, "edge"),  axis=0, keepdims=True)
+        points = np.linalg.norm(api.feature_detection(y, self.ppd, "point"), axis=0, keepdims=True)
+        return preprocessed, edges, points
+
+    def radius(self):
+        # how far the filters reach, the feature detectors use 3 sd of their
+        #   gaussian (sd = 0.5 * 0.082 degrees)
+        return max(self.filters[3], int(np.ceil(3 * 0.5 * 0.082 * self.ppd)))
+
+    def _error(self, ref_features, img_features):
+        api, _ = load_flip_api()
+        ref_preprocessed, ref_edges, ref_points = ref_features
+        preprocessed, edges, points             = img_features
+
+        delta_e_c = api.redistribute_errors(np.power(api.hyab(ref_preprocessed, preprocessed), self.qc),
+                                            self.cmax, self.pc, self.pt)
+        delta_e_f = np.maximum(abs(edges - ref_edges), abs(points - ref_points))
+        delta_e_f = np.power((1 / np.sqrt(2)) * delta_e_f, self.qf)
+
+        return np.squeeze(np.power(delta_e_c, 1 - delta_e_f), axis=0)
+
+    def evaluate(self, img):
+        return self._error((self.preprocessed, self.edges, self.points), self._prepare(load_flip_array(img)))
+
+    def evaluate_region(self, ref_image, image):
+        # both channel first arrays as load_flip_array returns them, e.g. a
+        #   crop or a pyramid level
+        return self._error(self._prepare(ref_image), self._prepare(image))
+
+    def evaluate_batch(self, imgs):
+        results = []
+        for img in imgs:
+            error_map = self.evaluate(img)
+            results.append((error_map, flip_stats_from_map(error_map)))
+        return results
+
+_flip_references      = {}
+_flip_references_lock = Lock()
+def flip_reference(ref):
+    key = (file_hash(ref), flip_pixels_per_degree)
+    with _flip_references_lock:
+        if key not in _flip_references:
+            # NOTE: a prepared reference holds several full size float maps,
+            #   only keep the ones of the last few figures around
+            if len(_flip_references) >= 4:
+                del _flip_references[next(iter(_flip_references))]
+            _flip_references[key] = FlipReference(ref)
+        return _flip_references[key]
+
+def flip_pyramid_level(image, level):
+    # box filtered 2**level downsampling of a channel first image
+    f    = 2 ** level
+    c, h, w = image.shape
+    image = np.pad(image, ((0, 0), (0, -h % f), (0, -w % f)), mode="edge")
+    return image.reshape(c, image.shape[1] // f, f, image.shape[2] // f, f).mean(axis=(2, 4))
+
+def preview_flip(ref, img, flip_path):
+    """Preview FLIP. The map is evaluated on a pyramid level at the matching
+    pixels per degree. The statistics come from a random subset of the full
+    resolution tiles, each padded by the filter radius so its values are the
+    exact ones, with an error bar on the mean."""
+    x, y = load_flip_array(ref), load_flip_array(img)
+
+    level = 2 ** preview_flip_level
+    small = FlipReference(None, flip_pixels_per_degree / level)
+    save_flip_image(small.evaluate_region(flip_pyramid_level(x, preview_flip_level),
+                                          flip_pyramid_level(y, preview_flip_level)), flip_path)
+
+    full    = FlipReference(None)
+    r       = full.radius()
+    _, h, w = x.shape
+    t       = preview_flip_tile
+    tiles   = [(ty, tx) for ty in range(0, h, t) for tx in range(0, w, t)]
+    count   = min(len(tiles), max(4, ceil(len(tiles) * preview_flip_fraction)))
+    chosen  = np.random.default_rng(preview_seed).choice(len(tiles), size=count, replace=False)
+
+    sums, areas, values = [], [], []
+    for i in sorted(chosen):
+        ty, tx = tiles[i]
+        ty1, tx1 = min(ty + t, h), min(tx + t, w)
+        py, px   = max(0, ty - r), max(0, tx - r)
+        py1, px1 = min(h, ty1 + r), min(w, tx1 + r)
+        error    = full.evaluate_region(x[:, py:py1, px:px1], y[:, py:py1, px:px1])[ty-py:ty1-py, tx-px:tx1-px]
+        sums.append(float(error.sum()))
+        areas.append(error.size)
+        values.append(error.ravel())
+
+    stats = flip_stats_from_map(np.concatenate(values))
+    sums, areas = np.array(sums), np.array(areas, dtype=np.float64)
+    mean        = sums.sum() / areas.sum()
+    error       = 0.0
+    if 1 < count < len(tiles):
+        # ratio estimator over a simple random sample of tiles
+        variance = (1 - count / len(tiles)) * np.var(sums - mean * areas, ddof=1) / count
+        error    = preview_z * float(np.sqrt(variance)) / areas.mean()
+    stats["Flip Mean"]     = float(mean)
+    stats["Flip Mean err"] = error
+    write_flip_stats(stats, flip_path[:-3]+"txt")
+
+def flip_output_path(ref, img):
+    return str(Path(flip_cache_dir + flip_cache_key(ref, img) + ".png").resolve())
+
+def flip_job(ref, img, owner=None):
+    # the subprocess that creates the cached FLIP files, None on a cache hit
+    flip_path = flip_output_path(ref, img)
+    if Path(flip_path).exists() and Path(flip_path[:-3]+"txt").exists():
+        with trace_span("flip", img=img, cache="hit"):
+            return None
+
+    Path(flip_cache_dir).mkdir(parents=True, exist_ok=True)
     flip_exe = str((Path(__file__).parent/Path("./flip/python/flip.py")).resolve())
-    run_cmd = " ".join(["python ", flip_exe,
-                        "-r", ref,
-                        "-t", img,
-                        "-d", str(Path(base_path).resolve()),
-                        "-b", str(flipped_images),
-                        "-txt"])
-    print()
-    print("Flip nr", flipped_images)
-    print(run_cmd, flush=True)
-    os.system(run_cmd)
+    return Job("flip", Path(flip_path).stem,
+               [sys.executable, flip_exe,
+                "-r", ref,
+                "-t", img,
+                "-d", str(Path(flip_cache_dir).resolve()),
+                "-b", Path(flip_path).stem,
+                "-txt", *flip_settings],
+               owner=owner or img)
 
-    flip_path = str(Path(base_path + str(flipped_images)+".png").resolve())
-    return flip_path
+def create_flip_image(ref, img):
+    if flip_backend == "subprocess" and not metrics_preview:
+        return create_flip_images([(ref, img)])[0]
+
+    with trace_span("flip", img=img, backend="preview" if metrics_preview else flip_backend) as span:
+        flip_path = flip_output_path(ref, img)
+        if Path(flip_path).exists() and Path(flip_path[:-3]+"txt").exists():
+            span["cache"] = "hit"
+            return flip_path
+        span["cache"] = "miss"
+
+        Path(flip_cache_dir).mkdir(parents=True, exist_ok=True)
+        if metrics_preview:
+            preview_flip(ref, img, flip_path)
+            return flip_path
+        error_map = flip_reference(ref).evaluate(img)
+        save_flip_image(error_map, flip_path)
+        write_flip_stats(flip_stats_from_map(error_map), flip_path[:-3]+"txt")
+        return flip_path
 
 def create_flip_image_and_stats(ref, img):
     out_png_file = create_flip_image(ref, img)
     stats        = read_flip_stats(out_png_file[:-3]+"txt")
     return out_png_file, stats
 
-cropped_image_counter = 0
-def create_cropped_image(path, trim):
-    global cropped_image_counter
-    print("cropping ", path, "...", sep="", flush=True)
-
-    image = Image.open(path)
-    res = image.size
-
-    # PIL crop((left, top, right, bottom))
-    # latex crop: left, bottom, right, top
-    image = image.crop((res[0]*trim[0], res[1]*trim[3], res[0] - res[0]*trim[2], res[1] - res[1]*trim[1]))
-
-    cropped_image_counter += 1
-    base_path = ".cropped/"
-    Path(base_path).mkdir(parents=True, exist_ok=True)
-
-    new_path = base_path + str(cropped_image_counter) + ".png"
-    image.save(new_path, "png")
-
-    return new_path
-
-def make_image(path, out_list, width=1, trim=(0,0,0,0), trim_at_compile=True):
-    if trim != (0,0,0,0) and trim_at_compile:
-        path = create_cropped_image(path, trim)
+flip_workers = os.cpu_count()
+
+def _map_unique(func, pairs, workers):
+    # NOTE: identical pairs share one job so two workers never write the same
+    #   cache file at once
+    unique = list(dict.fromkeys(pairs))
+    with ThreadPoolExecutor(max_workers=workers or flip_workers) as pool:
+        results = dict(zip(unique, pool.map(lambda p: func(*p), unique)))
+    return [results[p] for p in pairs]
+
+def create_flip_images(pairs, workers=None):
+    if tex_only:
+        return [flip_output_path(ref, img) for ref, img in pairs]
+    if flip_backend == "inprocess" or metrics_preview:
+        return _map_unique(create_flip_image, pairs, workers)
+
+    jobs = [job for job in (flip_job(ref, img) for ref, img in dict.fromkeys(pairs)) if job is not None]
+    for job in run_jobs(jobs, workers):
+        check_job(job)
+    return [flip_output_path(ref, img) for ref, img in pairs]
+
+def create_flip_images_and_stats(pairs, workers=None):
+    return [(png_file, read_flip_stats(png_file[:-3]+"txt")) for png_file in create_flip_images(pairs, workers)]
+
+METRICS_VERSION = 1
+metrics_db_path = ".metrics.sqlite"
+
+def similarity_metrics_version():
+    if metrics_preview:
+        return "sim-%d-%d-preview-%s" % (METRICS_VERSION, ssim_win_size, preview_version())
+    return "sim-%d-%d" % (METRICS_VERSION, ssim_win_size)
+
+def flip_metrics_version():
+    if metrics_preview:
+        return "flip-%d-preview-" % METRICS_VERSION + content_key(flip_pixels_per_degree, preview_version())[:12]
+    settings = flip_settings if flip_backend == "subprocess" else (FLIP_INPROCESS_VERSION,)
+    return "flip-%d-" % METRICS_VERSION + content_key(flip_backend, flip_pixels_per_degree, *settings)[:12]
+
+_metrics_db      = None
+_metrics_db_lock = Lock()
+def metrics_db():
+    global _metrics_db
+    if _metrics_db is None:
+        _metrics_db = sqlite3.connect(metrics_db_path, check_same_thread=False)
+        _metrics_db.execute("""CREATE TABLE IF NOT EXISTS metrics (
+                                   ref_hash TEXT, img_hash TEXT, version TEXT,
+                                   ref_path TEXT, img_path TEXT,
+                                   name TEXT, value REAL,
+                                   PRIMARY KEY (ref_hash, img_hash, version, name))""")
+    return _metrics_db
+
+def lookup_metrics(ref, img, version):
+    with _metrics_db_lock:
+        rows = metrics_db().execute("SELECT name, value FROM metrics WHERE ref_hash=? AND img_hash=? AND version=?",
+                                    (file_hash(ref), file_hash(img), version)).fetchall()
+    return {name: value for name, value in rows} or None
+
+def store_metrics(ref, img, version, values):
+    rows = [(file_hash(ref), file_hash(img), version, str(ref), str(img), name, float(value))
+            for name, value in values.items()]
+    with _metrics_db_lock, metrics_db() as db:
+        db.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+def export_metrics(file_name):
+    with _metrics_db_lock:
+        rows = metrics_db().execute("SELECT ref_path, img_path, ref_hash, img_hash, version, name, value "
+                                    "FROM metrics ORDER BY ref_path, img_path, version, name").fetchall()
+
+    if file_name.endswith(".json"):
+        pairs = {}
+        for ref_path, img_path, ref_hash, img_hash, version, name, value in rows:
+            pair = pairs.setdefault((ref_hash, img_hash), {"ref": ref_path, "img": img_path,
+                                                            "ref_hash": ref_hash, "img_hash": img_hash})
+            pair.setdefault(version, {})[name] = value
+        with open(file_name, "w") as out_file:
+            json.dump(list(pairs.values()), out_file, indent=2)
+    else:
+        with open(file_name, "w", newline="") as out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(("ref", "img", "ref_hash", "img_hash", "version", "name", "value"))
+            writer.writerows(rows)
+
+    return len(rows)
+
+def get_similarity_values_cached(ref, imgs):
+    version = similarity_metrics_version()
+    with trace_span("metrics.lookup", path=ref, candidates=len(imgs)) as span:
+        results = {img: lookup_metrics(ref, img, version) for img in imgs}
+        missing = [img for img, values in results.items() if values is None]
+        span["cache"] = "miss" if missing else "hit"
+        span["missing"] = len(missing)
+
+    if missing:
+        for img, values in zip(missing, get_similarity_values_batch(ref, missing)):
+            store_metrics(ref, img, version, values)
+            results[img] = values
+
+    return [dict(results[img]) for img in imgs]
+
+def cached_figure_metrics(ref, imgs):
+    # what compute_figure_metrics returns, from the metrics database only
+    nan     = float("nan")
+    metrics = []
+    for img in imgs:
+        values = dict.fromkeys(("MSE", "PSNR", "SSIM", "Flip Mean"), nan)
+        for version in (flip_metrics_version(), similarity_metrics_version()):
+            values.update(lookup_metrics(ref, img, version) or {})
+        metrics.append(values)
+    return create_flip_images([(ref, img) for img in imgs]), metrics
+
+def compute_figure_metrics(ref, imgs):
+    if tex_only:
+        return cached_figure_metrics(ref, imgs)
+
+    # NOTE: like get_similarity_values_cached, only pairs the database doesn't
+    #   have yet are read from the FLIP .txt and stored
+    flip_imgs = create_flip_images([(ref, img) for img in imgs])
+    version   = flip_metrics_version()
+    flips     = []
+    for img, flip_img in zip(imgs, flip_imgs):
+        flip_stats = lookup_metrics(ref, img, version)
+        if flip_stats is None:
+            flip_stats = read_flip_stats(flip_img[:-3]+"txt")
+            store_metrics(ref, img, version, flip_stats)
+        flips.append(flip_stats)
+
+    metrics = []
+    for flip_stats, sim in zip(flips, get_similarity_values_cached(ref, imgs)):
+        metrics.append(dict(flip_stats, **sim))
+
+    return flip_imgs, metrics
+
+# NOTE: how generated crops and FLIP maps are encoded. "fast" keeps the build
+#   loop quick, "final" squeezes the PDF, "preview" goes lossy
+intermediate_modes = {
+    "none":    {"format": "png",  "compress_level": 0},
+    "fast":    {"format": "png",  "compress_level": 1},
+    "default": {"format": "png",  "compress_level": 6},
+    "final":   {"format": "png",  "compress_level": 9, "optimize": True},
+    "preview": {"format": "jpeg", "quality": 85},
+}
+intermediate_mode = "fast"
+encode_workers    = os.cpu_count()
+
+def intermediate_extension():
+    return {"png": ".png", "jpeg": ".jpg"}[intermediate_modes[intermediate_mode]["format"]]
+
+def save_intermediate(image, path, lossy=True):
+    options = dict(intermediate_modes[intermediate_mode])
+    if options["format"] == "jpeg" and not lossy:
+        options = {"format": "png", "compress_level": 1}
+    if options["format"] == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    # NOTE: write next to the final name and rename, so an interrupted run
+    #   never leaves a truncated file under a valid key
+    with trace_span("encode", path=path, format=options["format"]) as span:
+        tmp_path = path + ".tmp"
+        image.save(tmp_path, **options)
+        os.replace(tmp_path, path)
+        span["bytes"] = os.path.getsize(path)
+
+_encode_pool      = None
+_pending_encodes  = {}
+_encode_pool_lock = Lock()
+
+def _encode_failed(future):
+    return future.done() and future.exception() is not None
+
+def encode_pending(path):
+    # a queued, running or finished-but-not-yet-removed encode of `path`; a
+    #   failed one doesn't count, the next request encodes the file again
+    with _encode_pool_lock:
+        future = _pending_encodes.get(path)
+        return future is not None and not _encode_failed(future)
+
+def _encode_done(path, future):
+    # NOTE: a failed encode stays pending until the file is requested again,
+    #   so everyone already waiting for it sees the error
+    if future.exception() is None:
+        with _encode_pool_lock:
+            if _pending_encodes.get(path) is future:
+                del _pending_encodes[path]
+
+def encode_in_background(image, path):
+    global _encode_pool
+    with _encode_pool_lock:
+        if path in _pending_encodes and not _encode_failed(_pending_encodes[path]):
+            return
+        if _encode_pool is None:
+            _encode_pool = ThreadPoolExecutor(max_workers=encode_workers)
+        future = _pending_encodes[path] = _encode_pool.submit(save_intermediate, image, path)
+    future.add_done_callback(lambda f: _encode_done(path, f))
+
+def wait_for_encodes(paths=None):
+    # every caller waits on the futures itself; they only leave
+    #   _pending_encodes once the file is in place
+    with _encode_pool_lock:
+        if paths is None:
+            paths = list(_pending_encodes)
+        pending = [_pending_encodes[path] for path in paths if path in _pending_encodes]
+    for future in pending:
+        future.result()
+
+crop_cache_dir = ".cropped/"
+
+# NOTE: with a target_dpi set, embedded images are resampled down to the
+#   resolution they actually get in the PDF. text_width_in is \textwidth of the
+#   standalone (article, 10pt) class
+target_dpi    = None
+text_width_in = 345 / 72.27
+
+def dpi_width_px(text_width):
+    # pixel width an image shown at `text_width` * \textwidth needs at target_dpi
+    if target_dpi is None or text_width is None or tex_only:
+        return None
+    return ceil(text_width * text_width_in * target_dpi)
+
+def create_cropped_image(path, trim, max_width=None, resample="nearest"):
+    """Crops `path` (latex trim order, fractions of the image) and, if the
+    crop is wider than max_width pixels, resamples it down to that width.
+    Returns `path` itself if there is nothing to do."""
+    if max_width is not None:
+        res = image_store.size(path)
+        if res[0] * (1 - trim[0] - trim[2]) <= max_width:
+            max_width = None
+    if not any(trim) and max_width is None:
+        return path
+
+    with trace_span("crop", path=path, trim=tuple(trim), max_width=max_width) as span:
+        resize   = () if max_width is None else (max_width, resample)
+        key      = content_key("crop", file_hash(path), *trim, *resize, sorted(intermediate_modes[intermediate_mode].items()))
+        new_path = crop_cache_dir + key + intermediate_extension()
+        if Path(new_path).exists() or encode_pending(new_path):
+            span["cache"] = "hit"
+            return new_path
+        span["cache"] = "miss"
+
+        Path(crop_cache_dir).mkdir(parents=True, exist_ok=True)
+
+        # NOTE: the name is known up front, so the figure can keep emitting TeX
+        #   while the inset is encoded; wait_for_encodes() runs before pdflatex
+        crop = image_store.crop(path, trim)
+        span["pixels"] = crop.shape[0] * crop.shape[1]
+        image = Image.fromarray(crop)
+        if max_width is not None:
+            # insets stay nearest neighbour so single pixels remain visible
+            method = Image.NEAREST if resample == "nearest" else Image.LANCZOS
+            image  = image.resize((max_width, max(1, round(crop.shape[0] * max_width / crop.shape[1]))), method)
+        encode_in_background(image, new_path)
+
+        return new_path
+
+tex_precision = 6  # significant digits
+
+def format_tex(value):
+    # NOTE: significant digits written out in positional notation, so TeX
+    #   never sees 1e-05 and tiny values don't collapse to 0, trailing zeros
+    #   dropped; NaN stands for a metric a --tex-only build doesn't have,
+    #   infinity is the PSNR of an identical region
+    if value != value:
+        return "--"
+    if isinstance(value, float) or (np._module is not None and isinstance(value, np.floating)):
+        if abs(value) == float("inf"):
+            return r"$\infty$" if value > 0 else r"$-\infty$"
+        text = format(Decimal("%.*g" % (tex_precision, value)), "f")
+        text = text.rstrip("0").rstrip(".") if "." in text else text
+        return "0" if text == "-0" else text
+    return str(value)
+
+class TexWriter:
+    """Takes the place of the out_list the figure functions fill (append /
+    extend), but formats every fragment once and writes it straight to a
+    file or an in-memory buffer. With standalone=True the document preamble is
+    written up front and close() finishes the document."""
+
+    def __init__(self, file=None, standalone=False):
+        self.path       = None
+        self.standalone = standalone
+        self.closed     = False
+        if file is None:
+            self.out = io.StringIO()
+        elif isinstance(file, (str, Path)):
+            self.path = str(file)
+            self.out  = open(file, "w")
+        else:
+            self.out = file
+
+        if standalone:
+            self.out.write(latex_standalone_preamble() + "\n" + r"\begin{document}")
+
+    def append(self, value):
+        self.out.write(format_tex(value))
+
+    def extend(self, values):
+        for value in values:
+            self.out.write(format_tex(value))
+
+    def getvalue(self):
+        return self.out.getvalue()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.standalone:
+            self.out.write(r"\end{document}" + "\n")
+        if self.path is not None:
+            self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def tex_text(content):
+    if isinstance(content, TexWriter):
+        return content.getvalue()
+    return "".join(format_tex(e) for e in content)
+
+def make_image(path, out_list, width=1, trim=(0,0,0,0), trim_at_compile=True, text_width=None, resample="nearest"):
+    # text_width: the fraction of \textwidth the surrounding \linewidth has,
+    #   only needed for resampling to target_dpi
+    max_width = dpi_width_px(text_width * width) if text_width is not None else None
+    if trim != (0,0,0,0) and trim_at_compile and not tex_only:
+        path = create_cropped_image(path, trim, max_width, resample)
         trim = (0,0,0,0)
+    elif not any(trim):
+        path = create_cropped_image(path, trim, max_width, resample)
 
     out_list.extend((r"""\adjincludegraphics[width=""", width,
                      r"""\linewidth,trim={{""",
                      trim[0],"\width} {",trim[1],"\height} {",trim[2],"\width} {",trim[3],"\height}",
                      """}, clip]{""",path,r"""}"""))
 
-def make_bordered_square(path, box_px, color, out_list):
+def make_bordered_square(path, box_px, color, out_list, text_width=None):
     out_list.append(r"""            \begin{tikzpicture}
               \node[anchor=south west,inner sep=0] at (0,0) {""")
 
-    make_image(path, out_list, width=1, trim=box_px)
+    make_image(path, out_list, width=1, trim=box_px, text_width=text_width)
     out_list.extend((r"""};
                 \draw[""",color,r""",ultra thick] (0,0) rectangle (\linewidth, \linewidth);
             \end{tikzpicture}"""))
@@ -156,9 +1313,12 @@ def calc_box_dim(box, aspect):
     return box_dim
 
 
-def do_one_line(images, paths, headers, box1, box2, ref_width, margin, show_grid, ref_crop, out_list):
-    r = Image.open(paths[0])
-    res = r.size
+def one_line_geometry(path, count, box1, box2, ref_width, margin, ref_crop):
+    """The layout of do_one_line for a reference `path` and `count` inset
+    columns. Returns the image aspect, the trims of the two insets, the boxes
+    in the grid of the (ref-cropped) reference, ref_crop as fractions and the
+    widths of the reference and an inset column relative to the text width."""
+    res = image_store.size(path)
     aspect = res[0] / res[1]
 
     box_1_width = calc_box_dim(box1, aspect)
@@ -197,10 +1357,23 @@ def do_one_line(images, paths, headers, box1, box2, ref_width, margin, show_grid
 
     if ref_width == -1:
         # ref_width = 2 * (minipage_width + margin) * aspect
-        ref_width = (len(images)*aspect * ((2-4*(len(images))*margin)/(len(images)) + 2*margin)) / (len(images) + 2*aspect)
+        ref_width = (count*aspect * ((2-4*(count)*margin)/(count) + 2*margin)) / (count + 2*aspect)
 
-    minipage_width = (1 - ref_width - (len(images)+1)*2*margin) / len(images)
+    minipage_width = (1 - ref_width - (count+1)*2*margin) / count
 
+    return aspect, box_1_width, box_2_width, box1, box2, ref_crop, ref_width, minipage_width
+
+def do_one_line(images, paths, headers, box1, box2, ref_width, margin, show_grid, ref_crop, out_list):
+    aspect, box_1_width, box_2_width, box1, box2, ref_crop, ref_width, minipage_width = \
+        one_line_geometry(paths[0], len(images), box1, box2, ref_width, margin, ref_crop)
+
+
+    # NOTE: the reference is trimmed by LaTeX, so only the visible part has to
+    #   reach target_dpi at ref_width
+    ref_path = paths[0]
+    if target_dpi is not None:
+        visible  = 1 - ref_crop[0] - ref_crop[2]
+        ref_path = create_cropped_image(paths[0], (0, 0, 0, 0), dpi_width_px(ref_width / visible), "lanczos")
 
     out_list.extend((r"""\begin{center}
         \bgroup
@@ -213,7 +1386,7 @@ def do_one_line(images, paths, headers, box1, box2, ref_width, margin, show_grid
     out_list.extend((r"""
         \begin{minipage}{""", ref_width, r"""\textwidth}
             \begin{tikzpicture}
-              \node[anchor=south west,inner sep=0] (image)  at (0,0) {\adjincludegraphics[width=\linewidth,trim={{""", ref_crop[0],"\width} {", ref_crop[1],"\height} {", ref_crop[2],"\width} {", ref_crop[3],"\height}}, clip", r"""]{""",  paths[0], r"""}};
+              \node[anchor=south west,inner sep=0] (image)  at (0,0) {\adjincludegraphics[width=\linewidth,trim={{""", ref_crop[0],"\width} {", ref_crop[1],"\height} {", ref_crop[2],"\width} {", ref_crop[3],"\height}}, clip", r"""]{""",  ref_path, r"""}};
               \begin{scope}[
                  x={($0.1*(image.south east)$)},
                  y={($0.1*(image.north west)$)}]
@@ -238,8 +1411,8 @@ def do_one_line(images, paths, headers, box1, box2, ref_width, margin, show_grid
         out_list.extend((r"""&
         \begin{minipage}{""",minipage_width,r"""\textwidth}"""))
 
-        make_bordered_square(path, box_1_width, "orange", out_list=out_list)
-        make_bordered_square(path, box_2_width, "blue", out_list=out_list)
+        make_bordered_square(path, box_1_width, "orange", out_list=out_list, text_width=minipage_width)
+        make_bordered_square(path, box_2_width, "blue", out_list=out_list, text_width=minipage_width)
 
         out_list.extend((r""" \vspace{""", 2*margin, r"""\textwidth} \end{minipage}"""))
 
@@ -254,8 +1427,7 @@ def do_horizontal_iteration_columns(images, flips, box1, box2, margin, out_list,
     #images [("name", paths...), ...]
     rows = images
 
-    r = Image.open(rows[0][1])
-    res = r.size
+    res = image_store.size(rows[0][1])
     aspect = res[0] / res[1]
 
     box_1_width = calc_box_dim(box1, aspect)
@@ -287,7 +1459,6 @@ def do_horizontal_iteration_columns(images, flips, box1, box2, margin, out_list,
     for row_idx, row in enumerate(images):
         #out_list.extend((r"\rotatebox[origin=c]{90}{", row[0] ,r"}"))
         squares = list(flatten(zip(row[1:], flips[row_idx])))
-        print("suqares: ", list(flatten(zip(row[1:], flips))), flush=True)
         for square_idx, square in enumerate(squares):
             if square_idx % 2 != 0:
                 continue
@@ -297,34 +1468,38 @@ def do_horizontal_iteration_columns(images, flips, box1, box2, margin, out_list,
             out_list.extend((r"""
         \begin{minipage}{""",minipage_width,r"""\textwidth}"""))
 
-            make_bordered_square(squares[square_idx],   box_1_width, "orange", out_list)
-            make_bordered_square(squares[square_idx+1], box_1_width, "orange", out_list)
-            make_bordered_square(squares[square_idx],   box_2_width, "blue", out_list)
-            make_bordered_square(squares[square_idx+1], box_2_width, "blue", out_list)
+            make_bordered_square(squares[square_idx],   box_1_width, "orange", out_list, text_width=minipage_width)
+            make_bordered_square(squares[square_idx+1], box_1_width, "orange", out_list, text_width=minipage_width)
+            make_bordered_square(squares[square_idx],   box_2_width, "blue", out_list, text_width=minipage_width)
+            make_bordered_square(squares[square_idx+1], box_2_width, "blue", out_list, text_width=minipage_width)
 
 
             out_list.append(r""" \end{minipage}""")
 
         out_list.append(r"""\\""")
 
+    if metrics_preview:
+        make_preview_note(num_columns, out_list)
+
     out_list.append(r"""
         \end{tabular}}
         \egroup
       \end{center}
       \vspace*{-1cm}""")
 
-def do_columns(paths, metrics, headers, box1, box2, margin, out_list, max_width):
-    r = Image.open(paths[0][0])
-    res = r.size
+def make_preview_note(columns, out_list):
+    # marks a figure built from sampled metrics or FLIP maps, as the last
+    #   row of its tabular
+    out_list.extend((r"""
+        \multicolumn{""", columns, r"""}{c}{\textcolor{red}{\small """, (preview_note % r"$\pm$").replace("%", r"\%"), r"}}\\"))
+
+def do_columns(paths, metrics, headers, box1, box2, margin, out_list, max_width, box_metrics=None):
+    res = image_store.size(paths[0][0])
     aspect = res[0] / res[1]
 
     box_1_width = calc_box_dim(box1, aspect)
     box_2_width = calc_box_dim(box2, aspect)
 
-    print("..................................")
-    print(box1, box2)
-    print(box_1_width, box_2_width)
-
     minipage_width = (max_width - (len(paths)*2*margin)) / len(paths)
 
     out_list.extend((r"""\begin{center}
@@ -356,10 +1531,10 @@ def do_columns(paths, metrics, headers, box1, box2, margin, out_list, max_width)
         out_list.extend((r"""
         &\begin{minipage}{""",minipage_width,r"""\textwidth}"""))
 
-        make_bordered_square(path_pack[0], box_1_width, "orange",out_list)
-        make_bordered_square(path_pack[1], box_1_width, "orange",out_list)
-        make_bordered_square(path_pack[0], box_2_width, "blue",out_list)
-        make_bordered_square(path_pack[1], box_2_width, "blue",out_list)
+        make_bordered_square(path_pack[0], box_1_width, "orange",out_list, text_width=minipage_width)
+        make_bordered_square(path_pack[1], box_1_width, "orange",out_list, text_width=minipage_width)
+        make_bordered_square(path_pack[0], box_2_width, "blue",out_list, text_width=minipage_width)
+        make_bordered_square(path_pack[1], box_2_width, "blue",out_list, text_width=minipage_width)
 
         out_list.append(r""" \end{minipage}""")
 
@@ -383,23 +1558,29 @@ def do_columns(paths, metrics, headers, box1, box2, margin, out_list, max_width)
               SSIM\\
          \end{tabular}""")
 
-    for idx, path_pack in enumerate(paths):
-        def maybe_make_blue(val, best):
-            val  = round_sig(val,  3)
-            best = round_sig(best, 3)
-            if val == best:
-                return r"\textcolor{blue}{"+str(val)+"}"
-            return val
+    def maybe_make_blue(val, best):
+        val  = round_sig(val,  3)
+        best = round_sig(best, 3)
+        if val == best:
+            return r"\textcolor{blue}{"+format_tex(val)+"}"
+        return val
 
+    def with_error(m, name, best):
+        # preview metrics are estimates, show the 95% interval with them
+        text = maybe_make_blue(m[name], best)
+        if name + " err" not in m:
+            return text
+        return format_tex(text) + r"{\tiny$\,\pm$" + format_tex(round_sig(m[name + " err"], 2)) + "}"
 
+    for idx, path_pack in enumerate(paths):
         m = metrics[idx]
         out_list.extend((r"""
         &
         \multicolumn{1}{r}{
          \begin{tabular}{ r }
-          """, maybe_make_blue(m["MSE"],  best_mse),        r"""\\
-          """, maybe_make_blue(m["PSNR"], best_psnr),       r"""\\
-          """, maybe_make_blue(m["SSIM"], best_ssim),      # r"""\\
+          """, with_error(m, "MSE",  best_mse),        r"""\\
+          """, with_error(m, "PSNR", best_psnr),       r"""\\
+          """, with_error(m, "SSIM", best_ssim),      # r"""\\
           # """,maybe_make_blue(m["Flip Mean"], best_fmean), r"""\\
           #""", round_sig(m["Flip Weighted median"]),       r"""\\
           #""", round_sig(m["Flip 1st weighted quartile"]), r"""\\
@@ -410,13 +1591,148 @@ def do_columns(paths, metrics, headers, box1, box2, margin, out_list, max_width)
          \end{tabular}}"""))
 
 
-    out_list.append(r""" & \multicolumn{1}{r}{\begin{tabular}{ r } \phantom{PSNR}\\\end{tabular}}
+    if box_metrics is not None:
+        # NOTE: the same three metrics, restricted to the orange and blue box
+        out_list.append(r"""\\
+          \begin{tabular}{ r }
+              \textcolor{orange}{MSE}\\
+              \textcolor{orange}{PSNR}\\
+              \textcolor{orange}{SSIM}\\
+              \textcolor{blue}{MSE}\\
+              \textcolor{blue}{PSNR}\\
+              \textcolor{blue}{SSIM}\\
+         \end{tabular}""")
+
+        best = [{"MSE":  min(bm[b]["MSE"]  for bm in box_metrics),
+                 "PSNR": max(bm[b]["PSNR"] for bm in box_metrics),
+                 "SSIM": max(bm[b]["SSIM"] for bm in box_metrics)} for b in range(2)]
+        for bm in box_metrics:
+            out_list.append(r"""
+        &
+        \multicolumn{1}{r}{
+         \begin{tabular}{ r }""")
+            for b in range(2):
+                for name in ("MSE", "PSNR", "SSIM"):
+                    out_list.extend(("""
+          """, maybe_make_blue(bm[b][name], best[b][name]), r"\\"))
+            out_list.append(r"""
+         \end{tabular}}""")
+
+    out_list.append(r""" & \multicolumn{1}{r}{\begin{tabular}{ r } \phantom{PSNR}\\\end{tabular}}""")
+
+    if metrics_preview or any("MSE err" in m for m in metrics):
+        out_list.append(r"\\")
+        make_preview_note(len(paths) + 2, out_list)
+
+    out_list.append(r"""
         \end{tabular}}
         \egroup
       \end{center}
       """)
 
 
+## ----------------------
+##      zoom boxes
+## ----------------------
+
+# NOTE: a box given as "auto" or ["auto", size] is placed where the
+#   candidates of the figure differ most from the reference. Boxes are square
+#   on screen, so every box size is one window size; an integral image scores
+#   all positions of a window in one pass over the error map
+auto_box_size      = 1.5
+auto_box_metric    = "squared"  # or "flip"
+auto_box_cache_dir = ".boxes/"
+
+def is_auto_box(box):
+    return box == "auto" or (lst_or_tpl(box) and len(box) == 2 and box[0] == "auto")
+
+def figure_error_map(ref, imgs, metric=None):
+    # per pixel error summed over all candidates
+    metric = metric or auto_box_metric
+    total  = None
+    for img in imgs:
+        if metric == "flip":
+            error = flip_reference(ref).evaluate(img)
+        elif metric == "squared":
+            diff  = image_store.load(ref).astype(np.float64) - image_store.load(img)
+            error = (diff * diff).reshape(diff.shape[0], diff.shape[1], -1).mean(axis=2)
+        else:
+            raise Exception("Unknown auto box metric: " + str(metric))
+        total = error if total is None else total + error
+    return total
+
+def box_window_sums(error, size):
+    # sums of every size x size window, indexed by its top left pixel
+    integral = np.zeros((error.shape[0] + 1, error.shape[1] + 1))
+    np.cumsum(np.cumsum(error, axis=0), axis=1, out=integral[1:, 1:])
+    return integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+
+def place_boxes(error, sizes, ref_crop=(0, 0, 0, 0), avoid=()):
+    """Picks one box per grid space size in `sizes`, in order, each where the
+    error inside it is highest. Boxes stay within the visible part of the
+    reference (ref_crop) and overlap neither each other nor the boxes in
+    `avoid`. Returns (x, y, size) in the grid units do_one_line takes."""
+    h, w   = error.shape
+    top    = ceil(ref_crop[3] / 10 * h)
+    bottom = floor((10 - ref_crop[1]) / 10 * h)
+    left   = ceil(ref_crop[0] / 10 * w)
+    right  = floor((10 - ref_crop[2]) / 10 * w)
+    visible = error[top:bottom, left:right]
+
+    # (row, col, pixels) relative to the visible part
+    taken = []
+    for x, y, size in avoid:
+        px = round(size / 10 * w)
+        taken.append((h - round(y / 10 * h) - px - top, round(x / 10 * w) - left, px))
+
+    boxes = []
+    for size in sizes:
+        px = round(size / 10 * w)
+        if px < 1 or px > visible.shape[0] or px > visible.shape[1]:
+            raise Exception("Box size " + str(size) + " does not fit into the visible part of the reference")
+
+        scores = box_window_sums(visible, px)
+        for row, col, other in taken:
+            scores[max(0, row - px + 1):max(0, row + other), max(0, col - px + 1):max(0, col + other)] = -np.inf
+        if not np.isfinite(scores).any():
+            raise Exception("No room left for a box of size " + str(size))
+
+        row, col = np.unravel_index(np.argmax(scores), scores.shape)
+        taken.append((row, col, px))
+        boxes.append((float((left + col) / w * 10), float((h - (top + row + px)) / h * 10), size))
+
+    return boxes
+
+def auto_boxes(ref, imgs, sizes, ref_crop=(0, 0, 0, 0), avoid=(), metric=None):
+    metric = metric or auto_box_metric
+    key    = content_key("boxes", metric, file_hash(ref), *[file_hash(i) for i in imgs], sizes, tuple(ref_crop),
+                         [tuple(box) for box in avoid], flip_pixels_per_degree if metric == "flip" else "")
+    path   = Path(auto_box_cache_dir)/(key + ".json")
+    if path.exists():
+        return [tuple(box) for box in json.loads(path.read_text())]
+    if tex_only:
+        raise Exception("Automatic boxes for " + str(ref) + " are not cached yet, run a full build once")
+
+    with trace_span("boxes", path=ref, candidates=len(imgs), metric=metric):
+        boxes = place_boxes(figure_error_map(ref, imgs, metric), sizes, ref_crop, avoid)
+    Path(auto_box_cache_dir).mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(boxes))
+    print("auto boxes for", str(ref) + ":", ", ".join("(%.4g, %.4g, %.4g)" % box for box in boxes))
+    return boxes
+
+def resolve_boxes(ref, imgs, boxes, ref_crop=(0, 0, 0, 0)):
+    # fills in the "auto" ones among `boxes`, they keep clear of the others
+    if not any(is_auto_box(box) for box in boxes):
+        return list(boxes)
+    if not imgs:
+        raise Exception("Automatic boxes for " + str(ref) + " need at least one candidate image to compare against")
+
+    fixed  = [tuple(box) for box in boxes if not is_auto_box(box)]
+    sizes  = [auto_box_size if box == "auto" else box[1] for box in boxes if is_auto_box(box)]
+    placed = iter(auto_boxes(ref, imgs, sizes, ref_crop, avoid=fixed))
+    return [next(placed) if is_auto_box(box) else box for box in boxes]
+
+
 ## ----------------------
 ##       figures
 ## ----------------------
@@ -426,43 +1742,49 @@ def one_line_figure(out_list, ref="", ref_crop=(0, 0, 0, 0), ref_width=-1, margi
     images  = [i    for i in (ref, cmp1, cmp2, cmp3, cmp4, cmp5) if i != ""]
     paths   = [p[1] if lst_or_tpl(p) else p for p in images]
     headers = [p[0] if lst_or_tpl(p) else "" for p in images]
+    box1, box2 = resolve_boxes(paths[0], paths[1:], (box1, box2), ref_crop)
     do_one_line(images=images, paths=paths, headers=headers,
                 box1=box1, box2=box2, ref_width=ref_width,
                 margin=margin, show_grid=show_grid, ref_crop=ref_crop, out_list=out_list)
 
 
 def vertical_flip_figure(out_list, ref="", ref_crop=(0, 0, 0, 0), ref_width=-1, margin=0.005, box1=(0, 0, 1), box2=(1, 1, 1),
-                         cmps=tuple(), show_grid=False):
+                         cmps=tuple(), show_grid=False, show_box_metrics=False):
     ref_img = [ref]
     paths   = [p[1] if lst_or_tpl(p) else p for p in ref_img]
     headers = [p[0] if lst_or_tpl(p) else "" for p in ref_img]
-    do_one_line(images=ref_img, paths=paths, headers=headers,
-                box1=box1, box2=box2, ref_width=ref_width,
-                margin=margin, show_grid=show_grid, ref_crop=ref_crop, out_list=out_list)
-
     images  = [i for i in cmps if i != ""]
 
     for i in images:
         if len(i) != 2:
             raise Exception("Each comparison image needs to have 2 components: " +
                             "name, path")
+    box1, box2 = resolve_boxes(ref[1], [p[1] for p in images], (box1, box2), ref_crop)
+
+    # NOTE: the reference row is emitted while FLIP and the metrics run
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        analysis = pool.submit(compute_figure_metrics, ref[1], [p[1] for p in images])
+        do_one_line(images=ref_img, paths=paths, headers=headers,
+                    box1=box1, box2=box2, ref_width=ref_width,
+                    margin=margin, show_grid=show_grid, ref_crop=ref_crop, out_list=out_list)
+        flip_imgs, metrics = analysis.result()
 
     paths        = []
-    metrics      = []
     headers      = []
-    for p in images:
-        flip_img, flip_stats = create_flip_image_and_stats(ref[1], p[1])
+    for p, flip_img in zip(images, flip_imgs):
         paths.append((p[1], flip_img))
-        flip_stats.update(get_similarity_values(ref[1], p[1]))
-        metrics.append(flip_stats)
         headers.append(p[0] if lst_or_tpl(p) else "")
 
 
     max_width = 0.8
 
+    box_metrics = None
+    if show_box_metrics:
+        box_metrics = box_similarity_values(ref[1], [p[1] for p in images], (box1, box2), ref_crop)
+
     do_columns(paths=paths, metrics=metrics, headers=headers,
                box1=box1, box2=box2, margin=margin, out_list=out_list,
-               max_width=max_width)
+               max_width=max_width, box_metrics=box_metrics)
 
 
 
@@ -471,34 +1793,29 @@ def single_flip_figure(out_list, ref="", ref_crop=(0, 0, 0, 0), ref_width=-1, ma
     ref_img = [ref]
     paths   = [p[1] if lst_or_tpl(p) else p for p in ref_img]
     headers = [p[0] if lst_or_tpl(p) else "" for p in ref_img]
-    do_one_line(images=ref_img, paths=paths, headers=headers,
-                box1=box1, box2=box2, ref_width=ref_width,
-                margin=margin, show_grid=show_grid, ref_crop=ref_crop, out_list=out_list)
-
     if len(cmp) != 2:
         raise Exception("Each comparison image needs to have 2 components: " +
                         "name, path")
+    box1, box2 = resolve_boxes(ref[1], [cmp[1]], (box1, box2), ref_crop)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        analysis = pool.submit(compute_figure_metrics, ref[1], [cmp[1]])
+        do_one_line(images=ref_img, paths=paths, headers=headers,
+                    box1=box1, box2=box2, ref_width=ref_width,
+                    margin=margin, show_grid=show_grid, ref_crop=ref_crop, out_list=out_list)
+        flip_imgs, metrics = analysis.result()
 
-    metrics      = []
     headers      = []
 
-    flip_img, flip_stats = create_flip_image_and_stats(ref[1], cmp[1])
-    paths        = [(cmp[1], flip_img)]
-    flip_stats.update(get_similarity_values(ref[1], cmp[1]))
-    metrics.append(flip_stats)
+    paths        = [(cmp[1], flip_imgs[0])]
     headers.append(cmp[0] if lst_or_tpl(cmp) else "")
 
-    r = Image.open(paths[0][0])
-    res = r.size
+    res = image_store.size(paths[0][0])
     aspect = res[0] / res[1]
 
     box_1_width = calc_box_dim(box1, aspect)
     box_2_width = calc_box_dim(box2, aspect)
 
-    print("..................................")
-    print(box1, box2)
-    print(box_1_width, box_2_width)
-
     minipage_width = (max_col_width - (len(paths)*4*margin)) / (len(paths)*2)
 
     out_list.extend((r"""\begin{center}
@@ -519,16 +1836,18 @@ def single_flip_figure(out_list, ref="", ref_crop=(0, 0, 0, 0), ref_width=-1, ma
         \begin{minipage}{""",minipage_width,r"""\textwidth}"""))
 
         if i == 0:
-            make_bordered_square(paths[0][0], box_1_width, "orange",out_list)
-            make_bordered_square(paths[0][1], box_1_width, "orange",out_list)
+            make_bordered_square(paths[0][0], box_1_width, "orange",out_list, text_width=minipage_width)
+            make_bordered_square(paths[0][1], box_1_width, "orange",out_list, text_width=minipage_width)
         else:
-            make_bordered_square(paths[0][0], box_2_width, "blue",out_list)
-            make_bordered_square(paths[0][1], box_2_width, "blue",out_list)
+            make_bordered_square(paths[0][0], box_2_width, "blue",out_list, text_width=minipage_width)
+            make_bordered_square(paths[0][1], box_2_width, "blue",out_list, text_width=minipage_width)
 
         out_list.append(r""" \end{minipage}""")
 
     out_list.append(r"\vspace{2mm}\\")
-    print("metrixs:", metrics)
+
+    if metrics_preview:
+        make_preview_note(2, out_list)
 
     out_list.append(r"""
         \end{tabular}}
@@ -545,29 +1864,29 @@ def horizontal_iterations_figure(out_list, ref="", ref_crop=(0, 0, 0, 0), ref_wi
     ref_img = [ref]
     paths   = [p[1] if lst_or_tpl(p) else p for p in ref_img]
     headers = [p[0] if lst_or_tpl(p) else "" for p in ref_img]
-    do_one_line(images=ref_img, paths=paths, headers=headers,
-                box1=box1, box2=box2, ref_width=ref_width,
-                margin=margin, show_grid=show_grid, ref_crop=ref_crop, out_list=out_list)
-
     images  = [i for i in (cmp1, cmp2, cmp3, cmp4, cmp5) if i != ""]
     if len(images) == 0:
         raise Exception("No comparison images supplied")
 
-    stats = []
+    pairs = [(ref[1], iter) for img in images for iter in img[1:]]
+    box1, box2 = resolve_boxes(ref[1], [iter for _, iter in pairs], (box1, box2), ref_crop)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        if print_stats:
+            analysis = pool.submit(compute_figure_metrics, ref[1], [iter for _, iter in pairs])
+        else:
+            analysis = pool.submit(create_flip_images, pairs)
+        do_one_line(images=ref_img, paths=paths, headers=headers,
+                    box1=box1, box2=box2, ref_width=ref_width,
+                    margin=margin, show_grid=show_grid, ref_crop=ref_crop, out_list=out_list)
+        if print_stats:
+            flipped, stats = analysis.result()
+        else:
+            flipped = analysis.result()
+
     flips = []
     for img in images:
-        l = []
-
-        for iter in img[1:]:
-            if print_stats:
-                png_file, flip_stats = create_flip_image_and_stats(ref[1], iter)
-                stats.append(flip_stats)
-                stats[-1].update(get_similarity_values(ref[1], iter))
-            else:
-                png_file = create_flip_image(ref[1], iter)
-            l.append(png_file)
-
-        flips.append(l)
+        flips.append(flipped[:len(img)-1])
+        flipped = flipped[len(img)-1:]
 
     num_images = len(images[0])-1
 
@@ -581,105 +1900,1012 @@ def horizontal_iterations_figure(out_list, ref="", ref_crop=(0, 0, 0, 0), ref_wi
 
 
 
-def make_latex_standalone(file_name, content, compile=True):
-    latex_list = [r"""\documentclass[preview]{standalone}
-\usepackage{tikz}
-\usepackage{adjustbox}
-\usetikzlibrary{calc}
-\usepackage[sc]{mathpazo}
+latex_build_log = []
 
-\begin{document}"""]
+def included_graphics(tex):
+    # NOTE: every image goes through \adjincludegraphics, both from
+    #   make_image and the reference in do_one_line
+    return list(dict.fromkeys(re.findall(r"\\adjincludegraphics\[.*?\]\{([^}]*)\}", tex)))
 
-    latex_list.extend(content)
+def latex_dependencies(tex):
+    return {"tex":    content_key(tex),
+            "inputs": {path: file_hash(path) for path in included_graphics(tex)}}
 
-    latex_list.append(r"""\end{document}""")
+def latex_rebuild_reason(file_name, deps):
+    deps_file = Path(file_name).with_suffix(".deps.json")
+    if not Path(file_name).with_suffix(".pdf").exists():
+        return "no pdf"
+    if not deps_file.exists():
+        return "no dependency record"
 
-    latex_list = (str(e) for e in latex_list)
+    with open(deps_file, "r") as in_file:
+        old_deps = json.load(in_file)
 
-    with open(file_name, "w") as out_file:
-        print("".join(latex_list), file=out_file)
+    if old_deps["tex"] != deps["tex"]:
+        return "tex changed"
+    changed = [path for path, h in deps["inputs"].items() if old_deps["inputs"].get(path) != h]
+    if changed:
+        return "inputs changed: " + ", ".join(changed)
+    return None
 
-    if compile:
-        print("compiling:")
+latex_packages = r"""\usepackage{tikz}
+\usepackage{adjustbox}
+\usetikzlibrary{calc}
+\usepackage[sc]{mathpazo}
+"""
+
+def latex_standalone_preamble():
+    return r"""\documentclass[preview]{standalone}
+""" + latex_packages
 
-        parent_dir = str(Path(file_name).parent)
+def write_latex_standalone(file_name, content):
+    with trace_span("tex", file=file_name) as span:
+        if isinstance(content, TexWriter) and content.standalone and content.path == str(file_name):
+            content.close()
+        else:
+            with TexWriter(file_name, standalone=True) as writer:
+                writer.append(tex_text(content))
+
+        with open(file_name, "r") as in_file:
+            tex = in_file.read()
+        span["bytes"] = len(tex)
+        return tex
+
+def record_latex_dependencies(file_name, deps):
+    with open(Path(file_name).with_suffix(".deps.json"), "w") as out_file:
+        json.dump(deps, out_file, indent=2)
+
+# NOTE: the preamble is the same for every figure, so it is dumped once into
+#   a format file (mylatexformat) that the figure compiles then load
+use_latex_format = True
+latex_format_dir = ".latex_format/"
+
+_pdflatex_version = None
+def pdflatex_version():
+    # NOTE: a .fmt only loads in the pdflatex that dumped it, so the version
+    #   is part of the format's name
+    global _pdflatex_version
+    if _pdflatex_version is None:
+        try:
+            _pdflatex_version = subprocess.run(["pdflatex", "--version"], capture_output=True, text=True,
+                                               timeout=30).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            _pdflatex_version = ""
+    return _pdflatex_version
+
+_latex_format_lock   = Lock()
+_latex_format_failed = set()
+def latex_format(preamble):
+    """Returns the name of a format file with `preamble` preloaded, building
+    it if the preamble or the pdflatex install changed, or None if it can't
+    be built."""
+    name = "preamble-" + content_key("format", preamble, pdflatex_version())[:16]
+    fmt  = Path(latex_format_dir) / (name + ".fmt")
+
+    with _latex_format_lock:
+        if fmt.exists():
+            return name
+        if name in _latex_format_failed:
+            return None
+
+        Path(latex_format_dir).mkdir(parents=True, exist_ok=True)
+        with open(Path(latex_format_dir) / (name + ".tex"), "w") as out_file:
+            print(preamble + "\n" + r"\begin{document}\end{document}", file=out_file)
+
+        print("building latex format", name)
+        job = run_job(Job("pdflatex", name + ".fmt",
+                          ["pdflatex", "-ini", "-interaction=nonstopmode", "-jobname="+name,
+                           "&pdflatex", "mylatexformat.ltx", name + ".tex"],
+                          cwd=latex_format_dir))
+        if job.status != 0 or not fmt.exists():
+            print("could not build latex format, compiling without it")
+            _latex_format_failed.add(name)
+            return None
+        return name
+
+def run_pdflatex(file_name, *args, preamble=None):
+    parent_dir = str(Path(file_name).parent)
+    env        = None
+
+    fmt = latex_format(preamble) if use_latex_format and preamble is not None else None
+    if fmt is not None:
+        env  = dict(os.environ, TEXFORMATS=str(Path(latex_format_dir).resolve()) + os.pathsep)
+        args = ("-fmt="+fmt, *args)
+
+    # NOTE: nonstopmode, so a broken figure ends with an error instead of
+    #   waiting for terminal input; the timeout catches the rest
+    job = run_job(Job("pdflatex", str(file_name),
+                      ["pdflatex",
+                       "-interaction=nonstopmode",
+                       "-aux-directory="+parent_dir,
+                       "-output-directory="+parent_dir,
+                       *args,
+                       file_name], env=env))
+    if job.status != 0:
+        print(JobFailed(job))
+    return job.status
 
-        res = os.system(" ".join(("pdflatex",
-                                  "-aux-directory="+parent_dir,
-                                  "-output-directory="+parent_dir,
-                                  file_name)))
+def make_latex_standalone(file_name, content, compile=True):
+    tex = write_latex_standalone(file_name, content)
+
+    if compile:
+        wait_for_encodes(included_graphics(tex))
+        deps   = latex_dependencies(tex)
+        reason = latex_rebuild_reason(file_name, deps)
+        latex_build_log.append((file_name, reason))
+        if reason is None:
+            print("up to date:", file_name)
+            with trace_span("pdflatex", file=file_name, cache="hit"):
+                return 0
+
+        print("compiling (", reason, "):", sep="")
+
+        res = run_pdflatex(file_name, preamble=latex_standalone_preamble())
         if res == 0:
             print("success! :)")
+            record_latex_dependencies(file_name, deps)
         else:
             print("no success :(")
 
         return res
 
+def pdf_split_tool():
+    # NOTE: neither is a hard dependency, batch builds need one of them
+    try:
+        import pypdf
+        return "pypdf"
+    except ImportError:
+        return "qpdf" if shutil.which("qpdf") else None
+
+def pdf_page_count(pdf_file):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        out = subprocess.run(["qpdf", "--show-npages", pdf_file], capture_output=True, text=True)
+        return int(out.stdout) if out.returncode == 0 else 0
+    return len(PdfReader(pdf_file).pages)
+
+def split_pdf_pages(pdf_file, out_files):
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        for page, out_file in enumerate(out_files, 1):
+            subprocess.run(["qpdf", pdf_file, "--pages", pdf_file, str(page), "--", str(out_file)], check=True)
+        return
+
+    reader = PdfReader(pdf_file)
+    for page, out_file in zip(reader.pages, out_files):
+        writer = PdfWriter()
+        writer.add_page(page)
+        with open(out_file, "wb") as out:
+            writer.write(out)
+
+def latex_errors_by_figure(log_file, line_ranges):
+    # NOTE: with -file-line-error pdflatex reports "<file>:<line>: <message>"
+    errors = {}
+    if not Path(log_file).exists():
+        return errors
+
+    with open(log_file, "r", errors="replace") as in_file:
+        for match in re.finditer(r"^.*?\.tex:(\d+): (.*)$", in_file.read(), re.MULTILINE):
+            line = int(match.group(1))
+            for file_name, (first, last) in line_ranges.items():
+                if first <= line <= last:
+                    errors.setdefault(file_name, []).append("line %d: %s" % (line - first + 1, match.group(2)))
+                    break
+            else:
+                errors.setdefault(None, []).append("line %d: %s" % (line, match.group(2)))
+    return errors
+
+def make_latex_batch(figures, batch_file="figures_batch.tex", compile=True):
+    """Compiles several figures ([(file_name, content), ...]) as pages of a
+    single document, then splits the pages into the per-figure PDFs that
+    make_latex_standalone would have produced. Every figure still gets its
+    own standalone .tex. Returns {file_name: pdflatex status}."""
+
+    results = {}
+    stale   = []
+    for file_name, content in figures:
+        tex = write_latex_standalone(file_name, content)
+        if not compile:
+            continue
+
+        wait_for_encodes(included_graphics(tex))
+        deps   = latex_dependencies(tex)
+        reason = latex_rebuild_reason(file_name, deps)
+        latex_build_log.append((file_name, reason))
+        if reason is None:
+            print("up to date:", file_name)
+            results[file_name] = 0
+        else:
+            body = tex[tex.index(r"\begin{document}") + len(r"\begin{document}"):tex.rindex(r"\end{document}")]
+            stale.append((file_name, body, deps))
+
+    if not stale:
+        return results
+
+    def compile_one_by_one():
+        for file_name, _, deps in stale:
+            res = run_pdflatex(file_name, preamble=latex_standalone_preamble())
+            if res == 0:
+                record_latex_dependencies(file_name, deps)
+            results[file_name] = res
+        return results
+
+    if pdf_split_tool() is None:
+        print("batch compile needs pypdf or qpdf to split the pages, compiling", len(stale), "figures one by one")
+        return compile_one_by_one()
+
+    # NOTE: this is what the standalone class does with [preview], one
+    #   tight page per preview environment
+    preamble    = r"""\documentclass{article}
+\usepackage[active,tightpage]{preview}
+\setlength\PreviewBorder{0.5bp}
+""" + latex_packages
+    latex_list  = [preamble, r"""
+\begin{document}
+"""]
+    line        = "".join(latex_list).count("\n") + 1
+    line_ranges = {}
+    for file_name, content, _ in stale:
+        body = r"\begin{preview}" + content + "\n" + r"\end{preview}" + "\n"
+        line_ranges[file_name] = (line, line + body.count("\n") - 1)
+        line += body.count("\n")
+        latex_list.append(body)
+    latex_list.append(r"""\end{document}""")
+
+    with open(batch_file, "w") as out_file:
+        print("".join(latex_list), file=out_file)
+
+    print("compiling", len(stale), "figures in", batch_file)
+    res       = run_pdflatex(batch_file, "-file-line-error", preamble=preamble)
+    batch_pdf = str(Path(batch_file).with_suffix(".pdf"))
+    errors    = latex_errors_by_figure(Path(batch_file).with_suffix(".log"), line_ranges)
+
+    for file_name, messages in errors.items():
+        print("error in", file_name or batch_file + " (outside any figure)")
+        for message in messages:
+            print("   ", message)
+
+    pages_ok = Path(batch_pdf).exists() and pdf_page_count(batch_pdf) == len(stale)
+    if pages_ok:
+        split_pdf_pages(batch_pdf, [Path(f).with_suffix(".pdf") for f, _, _ in stale])
+    else:
+        # NOTE: without one page per figure the pages can't be told apart
+        print("batch PDF doesn't have one page per figure, compiling", len(stale), "figures one by one")
+        return compile_one_by_one()
+
+    for file_name, _, deps in stale:
+        ok = file_name not in errors and None not in errors
+        if ok:
+            record_latex_dependencies(file_name, deps)
+        results[file_name] = 0 if ok else (res or 1)
+
+    return results
+
+
+## ----------------------
+##    raster previews
+## ----------------------
+
+# NOTE: a quick look at a layout without LaTeX. The figure arguments, box and
+#   crop geometry are the ones of the TeX figures, the typesetting (fonts,
+#   spacing) is only approximated
+raster_width = 1200  # pixels for \textwidth
+raster_line  = 1.6   # ultra thick, in pt
+raster_colors = {"orange": (255, 128, 0), "blue": (0, 0, 255), "red": (255, 0, 0),
+                 "lightgray": (191, 191, 191), "black": (0, 0, 0)}
+
+def _raster_px(fraction):
+    return max(1, round(fraction * raster_width))
+
+def _raster_font(size):
+    from PIL import ImageFont
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # NOTE: Pillow < 10.1 only has the fixed size bitmap font
+        return ImageFont.load_default()
+
+def _raster_text(lines, size=None, align="center"):
+    # lines: [(text, color), ...] one below the other
+    from PIL import ImageDraw
+    font    = _raster_font(size or _raster_px(0.014))
+    boxes   = [font.getbbox(text or " ") for text, _ in lines]
+    width   = max(b[2] for b in boxes) + 2
+    step    = round(max(b[3] for b in boxes) * 1.25)
+    image   = Image.new("RGB", (width, step * len(lines)), "white")
+    draw    = ImageDraw.Draw(image)
+    for i, ((text, color), box) in enumerate(zip(lines, boxes)):
+        x = {"left": 0, "center": (width - box[2]) // 2, "right": width - box[2]}[align]
+        draw.text((x, i * step), text, fill=raster_colors.get(color, color), font=font)
+    return image
+
+def _raster_value(value):
+    # format_tex, but spelling out infinity instead of TeX math (the bitmap
+    #   fallback font is latin-1 only)
+    return format_tex(value).replace(r"$\infty$", "inf").replace(r"$-\infty$", "-inf")
+
+def _raster_crop(path, trim, width, resample="nearest"):
+    # the crop create_cropped_image would write, scaled to `width` pixels
+    crop   = image_store.crop(path, trim)
+    image  = Image.fromarray(crop).convert("RGB")
+    height = max(1, round(width * crop.shape[0] / crop.shape[1]))
+    method = Image.NEAREST if resample == "nearest" else Image.BILINEAR
+    return image.resize((width, height), method, reducing_gap=None if resample == "nearest" else 2.0)
+
+def _raster_square(path, trim, color, width):
+    from PIL import ImageDraw
+    image = _raster_crop(path, trim, width)
+    ImageDraw.Draw(image).rectangle((0, 0, image.width - 1, image.height - 1),
+                                    outline=raster_colors[color], width=max(1, round(raster_line * raster_width / 345)))
+    return image
+
+def _raster_stack(images, gap=0, align="center"):
+    images = [i for i in images if i is not None]
+    width  = max(i.width for i in images)
+    image  = Image.new("RGB", (width, sum(i.height for i in images) + gap * (len(images) - 1)), "white")
+    y      = 0
+    for i in images:
+        x = {"left": 0, "center": (width - i.width) // 2, "right": width - i.width}[align]
+        image.paste(i, (x, y))
+        y += i.height + gap
+    return image
+
+def _raster_row(cells, widths, margin):
+    # a tabular row: every cell centered in its column, tabcolsep on both sides
+    sep    = round(margin * raster_width)
+    height = max((c.height for c in cells if c is not None), default=1)
+    image  = Image.new("RGB", (sum(widths) + 2 * sep * len(widths), height), "white")
+    x      = sep
+    for cell, width in zip(cells, widths):
+        if cell is not None:
+            image.paste(cell, (x + (width - cell.width) // 2, (height - cell.height) // 2))
+        x += width + 2 * sep
+    return image
+
+def _raster_one_line(paths, headers, box1, box2, ref_width, margin, show_grid, ref_crop):
+    from PIL import ImageDraw
+    aspect, box_1_width, box_2_width, box1, box2, ref_crop, ref_width, minipage_width = \
+        one_line_geometry(paths[0], len(paths), box1, box2, ref_width, margin, ref_crop)
+
+    # reference, trimmed like \adjincludegraphics, with tikz's 10x10 grid
+    ref  = _raster_crop(paths[0], ref_crop, _raster_px(ref_width), "bilinear")
+    draw = ImageDraw.Draw(ref)
+    w, h = ref.size
+    line = max(1, round(raster_line * raster_width / 345))
+    if show_grid:
+        for i in range(1, 10):
+            draw.line((w * i / 10, 0, w * i / 10, h), fill=raster_colors["lightgray"])
+            draw.line((0, h * i / 10, w, h * i / 10), fill=raster_colors["lightgray"])
+    for box, color in ((box1, "orange"), (box2, "blue")):
+        draw.rectangle((w * box[0] / 10, h - h * (box[1] + box[2] * aspect) / 10,
+                        w * (box[0] + box[2]) / 10, h - h * box[1] / 10), outline=raster_colors[color], width=line)
+
+    column  = _raster_px(minipage_width)
+    insets  = [_raster_stack([_raster_square(p, box_1_width, "orange", column),
+                              _raster_square(p, box_2_width, "blue", column)], gap=_raster_px(margin))
+               for p in paths]
+    widths  = [ref.width] + [column] * len(paths)
+    return _raster_stack([_raster_row([None] + [_raster_text([(header, "black")]) for header in headers], widths, margin),
+                          _raster_row([ref] + insets, widths, margin)])
+
+def _raster_columns(pairs, metrics, headers, box1, box2, margin, max_width, box_metrics=None):
+    res    = image_store.size(pairs[0][0])
+    aspect = res[0] / res[1]
+    column = _raster_px((max_width - (len(pairs)*2*margin)) / len(pairs))
+
+    cells = [_raster_stack([_raster_square(p, calc_box_dim(box, aspect), color, column)
+                            for box, color in ((box1, "orange"), (box2, "blue")) for p in pair], gap=_raster_px(margin))
+             for pair in pairs]
+
+    names  = [("MSE", min), ("PSNR", max), ("SSIM", max)]
+    labels = [(name, "black") for name, _ in names]
+    values = [[] for _ in pairs]
+    for name, pick in names:
+        best = round_sig(pick(m[name] for m in metrics), 3)
+        for value, m in zip(values, metrics):
+            text = _raster_value(round_sig(m[name], 3))
+            if name + " err" in m:
+                text += " ±" + _raster_value(round_sig(m[name + " err"], 2))
+            value.append((text, "blue" if round_sig(m[name], 3) == best else "black"))
+
+    if box_metrics is not None:
+        for b, color in enumerate(("orange", "blue")):
+            for name, pick in names:
+                labels.append((name, color))
+                best = round_sig(pick(bm[b][name] for bm in box_metrics), 3)
+                for value, bm in zip(values, box_metrics):
+                    value.append((_raster_value(round_sig(bm[b][name], 3)),
+                                  "blue" if round_sig(bm[b][name], 3) == best else "black"))
+
+    label  = _raster_text(labels, align="right")
+    widths = [label.width] + [column] * len(pairs)
+    rows   = [_raster_row([None] + [_raster_text([(header, "black")]) for header in headers], widths, margin),
+              _raster_row([None] + cells, widths, margin),
+              _raster_row([label] + [_raster_text(v, align="right") for v in values], widths, margin)]
+    if metrics_preview or any("MSE err" in m for m in metrics):
+        rows.append(_raster_text([(preview_note % "±", "red")]))
+    return _raster_stack(rows, gap=_raster_px(margin))
+
+def _raster_single_flip(pair, header, box1, box2, margin, max_col_width):
+    # single_flip_figure: no metrics, the orange and the blue box side by side
+    res    = image_store.size(pair[0])
+    aspect = res[0] / res[1]
+    column = _raster_px((max_col_width - 4*margin) / 2)
+    widths = [column] * 2
+
+    cells = [_raster_stack([_raster_square(p, calc_box_dim(box, aspect), color, column) for p in pair])
+             for box, color in ((box1, "orange"), (box2, "blue"))]
+    rows  = [_raster_text([(header, "black")]), _raster_row(cells, widths, margin)]
+    if metrics_preview:
+        rows.append(_raster_text([(preview_note % "±", "red")]))
+    return _raster_stack(rows, gap=_raster_px(margin))
+
+def _raster_iterations(images, flips, box1, box2, margin, iter_names, iter_title, columns_total_width):
+    res     = image_store.size(images[0][1])
+    aspect  = res[0] / res[1]
+    count   = len(flips[0])
+    column  = _raster_px((columns_total_width - (count*margin)) / count)
+    widths  = [column] * count
+    names   = iter_names if iter_names is not None else ["iter %d" % (i+1) for i in range(count)]
+
+    rows = []
+    if iter_title:
+        rows.append(_raster_text([(str(iter_title), "black")]))
+    rows.append(_raster_row([_raster_text([(n, "black")]) for n in names], widths, margin))
+    for row, row_flips in zip(images, flips):
+        rows.append(_raster_row([_raster_stack([_raster_square(p, calc_box_dim(box, aspect), color, column)
+                                                for box, color in ((box1, "orange"), (box2, "blue"))
+                                                for p in (img, flip)], gap=_raster_px(margin))
+                                 for img, flip in zip(row[1:], row_flips)], widths, margin))
+    if metrics_preview:
+        rows.append(_raster_text([(preview_note % "±", "red")]))
+    return _raster_stack(rows, gap=_raster_px(margin))
+
+def raster_figure(file_name, kind, **args):
+    """Writes a PNG approximating the figure `kind` (one_line, vertical_flip,
+    single_flip, horizontal_iterations) with the arguments its TeX function takes. FLIP
+    maps and metrics come from the usual caches."""
+    if kind not in figure_builders:
+        raise Exception("Unknown figure type: " + str(kind))
+    bound = inspect.signature(figure_builders[kind]).bind(None, **args)
+    bound.apply_defaults()
+    a = bound.arguments
+    a["box1"], a["box2"] = resolve_boxes(_path_of(a["ref"]), figure_inputs({"type": kind, "args": a})[1:],
+                                         (a["box1"], a["box2"]), a["ref_crop"])
+
+    with trace_span("raster", file=file_name, type=kind):
+        ref = a["ref"]
+        if kind == "one_line":
+            images = [i for i in (ref, a["cmp1"], a["cmp2"], a["cmp3"], a["cmp4"], a["cmp5"]) if i != ""]
+            blocks = [_raster_one_line([_path_of(i) for i in images], [i[0] if lst_or_tpl(i) else "" for i in images],
+                                       a["box1"], a["box2"], a["ref_width"], a["margin"], a["show_grid"], a["ref_crop"])]
+        elif kind == "vertical_flip":
+            cmps = [c for c in a["cmps"] if c != ""]
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                analysis = pool.submit(compute_figure_metrics, ref[1], [c[1] for c in cmps])
+                top      = _raster_one_line([ref[1]], [ref[0]], a["box1"], a["box2"], a["ref_width"], a["margin"],
+                                            a["show_grid"], a["ref_crop"])
+                flip_imgs, metrics = analysis.result()
+            box_metrics = None
+            if a.get("show_box_metrics"):
+                box_metrics = box_similarity_values(ref[1], [c[1] for c in cmps], (a["box1"], a["box2"]), a["ref_crop"])
+            blocks = [top, _raster_columns([(c[1], f) for c, f in zip(cmps, flip_imgs)], metrics, [c[0] for c in cmps],
+                                           a["box1"], a["box2"], a["margin"], 0.8, box_metrics)]
+        elif kind == "single_flip":
+            cmp = a["cmp"]
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                analysis = pool.submit(create_flip_images, [(ref[1], cmp[1])])
+                top      = _raster_one_line([ref[1]], [ref[0]], a["box1"], a["box2"], a["ref_width"], a["margin"],
+                                            a["show_grid"], a["ref_crop"])
+                flip_img = analysis.result()[0]
+            blocks = [top, _raster_single_flip((cmp[1], flip_img), cmp[0] if lst_or_tpl(cmp) else "",
+                                               a["box1"], a["box2"], a["margin"], a["max_col_width"])]
+        elif kind == "horizontal_iterations":
+            images = [i for i in (a["cmp1"], a["cmp2"], a["cmp3"], a["cmp4"], a["cmp5"]) if i != ""]
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                analysis = pool.submit(create_flip_images, [(ref[1], it) for img in images for it in img[1:]])
+                top      = _raster_one_line([ref[1]], [ref[0]], a["box1"], a["box2"], a["ref_width"], a["margin"],
+                                            a["show_grid"], a["ref_crop"])
+                flipped  = analysis.result()
+            flips = []
+            for img in images:
+                flips.append(flipped[:len(img)-1])
+                flipped = flipped[len(img)-1:]
+            blocks = [top, _raster_iterations(images, flips, a["box1"], a["box2"], a["margin"],
+                                              a["iter_names"], a["iter_title"], a["columns_total_width"])]
+        else:
+            raise Exception("No raster preview for " + kind + " figures")
+
+        image  = _raster_stack(blocks, gap=_raster_px(0.01))
+        canvas = Image.new("RGB", (max(image.width, raster_width), image.height + 2 * _raster_px(0.01)), "white")
+        canvas.paste(image, ((canvas.width - image.width) // 2, _raster_px(0.01)))
+        canvas.save(file_name, compress_level=1)
+    return file_name
+
+
+## ----------------------
+##     manifest builds
+## ----------------------
+
+figure_builders = {
+    "one_line":              one_line_figure,
+    "vertical_flip":         vertical_flip_figure,
+    "single_flip":           single_flip_figure,
+    "horizontal_iterations": horizontal_iterations_figure,
+}
+
+def load_manifest(file_name):
+    with open(file_name, "rb") as in_file:
+        if str(file_name).endswith(".toml"):
+            # NOTE: tomllib is Python 3.11+, JSON manifests work everywhere
+            try:
+                import tomllib
+            except ImportError:
+                raise Exception("TOML manifests need Python 3.11 or newer, use a JSON manifest for " + str(file_name))
+            return tomllib.load(in_file)
+        return json.load(in_file)
+
+def _path_of(image):
+    return image[1] if lst_or_tpl(image) else image
+
+def figure_pairs(figure):
+    # (ref, candidate, with_metrics) for every FLIP evaluation a figure needs
+    args = figure.get("args", {})
+    ref  = _path_of(args.get("ref", ""))
+    kind = figure["type"]
+
+    if kind == "vertical_flip":
+        return [(ref, c[1], True) for c in args.get("cmps", ()) if c != ""]
+    if kind == "single_flip":
+        return [(ref, args["cmp"][1], True)]
+    if kind == "horizontal_iterations":
+        return [(ref, it, args.get("print_stats", False))
+                for k in ("cmp1", "cmp2", "cmp3", "cmp4", "cmp5") if args.get(k, "") != ""
+                for it in args[k][1:]]
+    return []
+
+def figure_inputs(figure):
+    args   = figure.get("args", {})
+    inputs = [_path_of(args.get("ref", ""))]
+    inputs.extend(_path_of(args[k]) for k in ("cmp1", "cmp2", "cmp3", "cmp4", "cmp5")
+                  if figure["type"] == "one_line" and args.get(k, "") != "")
+    inputs.extend(img for _, img, _ in figure_pairs(figure))
+    return [i for i in dict.fromkeys(inputs) if i != ""]
+
+def build_figure_tex(figure):
+    builder = figure_builders[figure["type"]]
+    with trace_span("figure", file=figure["output"], type=figure["type"]):
+        writer  = TexWriter(figure["output"], standalone=True)
+        builder(out_list=writer, **figure.get("args", {}))
+    return writer
+
+def run_task_graph(tasks, jobs):
+    """Runs every task of `tasks` ({name: (func, deps)} or (func, deps, after))
+    once all of its deps have finished, at most `jobs` at a time. Each func
+    gets the results of all finished tasks. A task that raises fails every
+    task depending on it, the rest of the graph still runs; tasks in `after`
+    only have to be finished, failed or not. Returns (results, failures)."""
+    results  = {}
+    failures = {}
+    waiting  = dict(tasks)
+    running  = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while waiting or running:
+            changed = True
+            while changed:
+                changed = False
+                for name, (func, deps, *_) in list(waiting.items()):
+                    failed = [d for d in deps if d in failures]
+                    if failed:
+                        failures[name] = failures[failed[0]]
+                        del waiting[name]
+                        changed = True
+
+            for name, (func, deps, *after) in list(waiting.items()):
+                if all(d in results for d in deps) and all(a in results or a in failures for a in flatten(after)):
+                    running[pool.submit(func, results)] = name
+                    del waiting[name]
+
+            if not running:
+                if waiting:
+                    raise Exception("Task graph has unsatisfiable dependencies: " + ", ".join(waiting))
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as error:
+                    failures[name] = error
+
+    return results, failures
+
+def manifest_task_graph(figures, compile=True, batch=None):
+    # flip / metrics -> tex -> pdflatex; work shared by several figures ends
+    #   up as a single task. Images are decoded by whichever task misses its
+    #   cache first, a fully cached build decodes nothing
+    tasks = {}
+
+    for figure in figures:
+        pairs    = figure_pairs(figure) if not tex_only else []
+        analysis = []
+        for ref, img, _ in pairs:
+            name = "flip:"+ref+"|"+img
+            tasks[name] = (lambda _, r=ref, i=img: create_flip_image_and_stats(r, i), [])
+            analysis.append(name)
+
+        metric_imgs = [img for _, img, with_metrics in pairs if with_metrics]
+        if metric_imgs:
+            ref  = pairs[0][0]
+            name = "metrics:"+ref+"|"+"|".join(metric_imgs)
+            tasks[name] = (lambda _, r=ref, i=metric_imgs: get_similarity_values_cached(r, i), [])
+            analysis.append(name)
+
+        output = figure["output"]
+        tasks["tex:"+output] = (lambda _, f=figure: build_figure_tex(f), analysis)
+        if not batch:
+            tasks["pdf:"+output] = (lambda results, o=output: make_latex_standalone(o, results["tex:"+o], compile=compile),
+                                    ["tex:"+output])
+
+    if batch:
+        # NOTE: a figure whose TeX failed is reported on its own, the batch
+        #   still compiles all the others
+        outputs = [f["output"] for f in figures]
+        tasks["pdf:batch"] = (lambda results: make_latex_batch([(o, results["tex:"+o]) for o in outputs
+                                                                if "tex:"+o in results],
+                                                               batch_file=batch, compile=compile),
+                              [], ["tex:"+o for o in outputs])
+
+    return tasks
+
+def build_manifest(manifest, jobs=None, compile=True, batch=None):
+    global flip_workers
+
+    jobs         = jobs or manifest.get("jobs") or os.cpu_count()
+    flip_workers = jobs
+    figures      = manifest["figures"]
+    latex_build_log.clear()
+
+    results, failures = run_task_graph(manifest_task_graph(figures, compile=compile, batch=batch), jobs)
+
+    errors = {}
+    for f in figures:
+        task = "pdf:batch" if batch else "pdf:"+f["output"]
+        if batch and "tex:"+f["output"] in failures:
+            errors[f["output"]] = failures["tex:"+f["output"]]
+        elif task in failures:
+            errors[f["output"]] = failures[task]
+        elif (results[task].get(f["output"]) if batch else results[task]):
+            errors[f["output"]] = "pdflatex failed"
+
+    for file_name, reason in latex_build_log:
+        print("  ", file_name + ":", "up to date" if reason is None else "rebuilt, " + reason)
+    for output, error in errors.items():
+        print("failed:", output + ":", error)
+    return list(errors)
+
+## ----------------------
+##        sharding
+## ----------------------
+
+# NOTE: a shard only computes the FLIP maps and metrics of its share of the
+#   (ref, candidate) pairs into a shared artifact directory; the merge then
+#   builds every figure from those caches. Pairs are assigned by content, so
+#   every machine agrees on the split no matter where the images are mounted
+artifacts_dir = ".artifacts/"
+
+def use_artifacts(artifacts):
+    global flip_cache_dir, metrics_db_path, _metrics_db
+    flip_cache_dir  = str(Path(artifacts)/"flip") + "/"
+    metrics_db_path = str(Path(artifacts)/"metrics.sqlite")
+    _metrics_db     = None
+    Path(artifacts).mkdir(parents=True, exist_ok=True)
+
+def shard_of(ref, img, count):
+    return int(content_key("shard", file_hash(ref), file_hash(img)), 16) % count
+
+def manifest_pairs(figures):
+    pairs = {}
+    for figure in figures:
+        for ref, img, with_metrics in figure_pairs(figure):
+            pairs[(ref, img)] = pairs.get((ref, img), False) or with_metrics
+    return pairs
+
+def shard_task_graph(pairs):
+    tasks = {}
+    by_ref = {}
+    for (ref, img), with_metrics in pairs.items():
+        def flip(_, r=ref, i=img):
+            _, stats = create_flip_image_and_stats(r, i)
+            store_metrics(r, i, flip_metrics_version(), stats)
+        tasks["flip:"+ref+"|"+img] = (flip, [])
+
+        if with_metrics:
+            by_ref.setdefault(ref, []).append(img)
+
+    for ref, imgs in by_ref.items():
+        tasks["metrics:"+ref] = (lambda _, r=ref, i=imgs: get_similarity_values_cached(r, i), [])
+    return tasks
+
+def build_shard(manifest, index, count, artifacts=None, jobs=None):
+    """Computes shard `index` of `count` of the FLIP and metric work of a
+    manifest into `artifacts`. Every shard writes its own metrics database
+    and a shard-<index>-of-<count>.json summary, FLIP files go to a directory
+    shared by all shards. Returns the list of failed pairs."""
+    global flip_workers, metrics_db_path
+    if not 0 <= index < count:
+        raise Exception("Shard index %d out of range for %d shards" % (index, count))
+
+    artifacts = Path(artifacts or artifacts_dir)
+    use_artifacts(artifacts)
+    metrics_db_path = str(artifacts/("shard-%d-of-%d.sqlite" % (index, count)))
+    # NOTE: creates the table even for a shard without pairs, the merge
+    #   attaches every shard's database
+    metrics_db()
+
+    jobs         = jobs or manifest.get("jobs") or os.cpu_count()
+    flip_workers = jobs
+    pairs        = {pair: m for pair, m in manifest_pairs(manifest["figures"]).items()
+                    if shard_of(*pair, count) == index}
+    print("shard %d/%d: %d pairs" % (index, count, len(pairs)), flush=True)
+
+    _, failures = run_task_graph(shard_task_graph(pairs), jobs)
+    for name, error in failures.items():
+        print("failed:", name, "-", error)
+
+    with open(artifacts/("shard-%d-of-%d.json" % (index, count)), "w") as out_file:
+        json.dump({"index": index, "count": count,
+                   "pairs": [[ref, img] for ref, img in pairs],
+                   "failed": sorted(failures)}, out_file, indent=2)
+    return sorted(failures)
+
+def merge_shards(manifest, artifacts=None, **build_args):
+    """Collects the metrics of all shards in `artifacts` and builds the
+    figures of the manifest from them. Raises if a shard is missing or left
+    work undone instead of computing it here."""
+    artifacts = Path(artifacts or artifacts_dir)
+    summaries = [json.loads(p.read_text()) for p in sorted(artifacts.glob("shard-*-of-*.json"))]
+    if not summaries:
+        raise Exception("No shards found in " + str(artifacts))
+
+    counts = sorted({s["count"] for s in summaries})
+    if len(counts) > 1:
+        raise Exception("Shards of different splits (%s) in %s, remove the stale ones"
+                        % (", ".join("of %d" % c for c in counts), artifacts))
+    count   = counts[0]
+    missing = set(range(count)) - {s["index"] for s in summaries}
+    if missing:
+        raise Exception("Missing shards %s of %d in %s" % (", ".join(map(str, sorted(missing))), count, artifacts))
+    failed = [name for s in summaries for name in s["failed"]]
+    if failed:
+        raise Exception("Shards failed on: " + ", ".join(failed))
+
+    use_artifacts(artifacts)
+    with _metrics_db_lock, metrics_db() as db:
+        for index in range(count):
+            # NOTE: ATTACH would create a missing file, and shards written
+            #   before they always made the table may have none
+            shard_db = artifacts/("shard-%d-of-%d.sqlite" % (index, count))
+            if not shard_db.exists():
+                continue
+            db.execute("ATTACH DATABASE ? AS shard", (str(shard_db),))
+            if db.execute("SELECT 1 FROM shard.sqlite_master WHERE type='table' AND name='metrics'").fetchone():
+                db.execute("INSERT OR REPLACE INTO metrics SELECT * FROM shard.metrics")
+                db.commit()
+            db.execute("DETACH DATABASE shard")
+
+    version = similarity_metrics_version()
+    undone  = [img for (ref, img), with_metrics in manifest_pairs(manifest["figures"]).items()
+               if not Path(flip_output_path(ref, img)[:-3]+"txt").exists()
+               or (with_metrics and lookup_metrics(ref, img, version) is None)]
+    if undone:
+        raise Exception("Shards are missing results for: " + ", ".join(undone))
+
+    return build_manifest(manifest, **build_args)
+
+def _file_state(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+_manifest_defaults = dict(target_dpi=target_dpi, metrics_preview=metrics_preview,
+                          metrics_engine=metrics_engine, auto_box_metric=auto_box_metric,
+                          auto_box_size=auto_box_size, intermediate_mode=intermediate_mode,
+                          flip_backend=flip_backend)
+
+def apply_manifest_settings(manifest, dpi=None, preview=False, intermediate=None, flip=None):
+    """Sets the module-level options a manifest can carry. Keys the manifest
+    doesn't have go back to their defaults, so a reloaded manifest doesn't
+    keep settings that were removed from it. dpi/preview/intermediate/flip
+    come from the command line and win over the manifest."""
+    global target_dpi, metrics_preview, metrics_engine, auto_box_metric, auto_box_size, intermediate_mode, flip_backend
+    settings = dict(_manifest_defaults, **{k: manifest[k] for k in _manifest_defaults if k in manifest})
+    if "preview" in manifest:
+        settings["metrics_preview"] = manifest["preview"]
+    if settings["metrics_engine"] not in ("batch", "tiled"):
+        raise Exception("Unknown metrics_engine: " + str(settings["metrics_engine"]))
+    if settings["auto_box_metric"] not in ("squared", "flip"):
+        raise Exception("Unknown auto_box_metric: " + str(settings["auto_box_metric"]))
+    settings["intermediate_mode"] = intermediate or settings["intermediate_mode"]
+    if settings["intermediate_mode"] not in intermediate_modes:
+        raise Exception("Unknown intermediate_mode: " + str(settings["intermediate_mode"]))
+    settings["flip_backend"] = flip or settings["flip_backend"]
+    if settings["flip_backend"] not in ("subprocess", "inprocess"):
+        raise Exception("Unknown flip_backend: " + str(settings["flip_backend"]))
+
+    target_dpi        = dpi or settings["target_dpi"]
+    metrics_preview   = preview or settings["metrics_preview"]
+    metrics_engine    = settings["metrics_engine"]
+    auto_box_metric   = settings["auto_box_metric"]
+    auto_box_size     = settings["auto_box_size"]
+    intermediate_mode = settings["intermediate_mode"]
+    flip_backend      = settings["flip_backend"]
+
+def watch_manifest(manifest_file, interval=0.5, on_build=None, on_load=None, **build_args):
+    """Builds the manifest, then keeps watching its input images (and the
+    manifest itself) and rebuilds only the figures that use a changed file.
+    Decoded images, prepared references and the FLIP/metric caches stay warm
+    in this process between rebuilds. on_load gets every (re)loaded manifest
+    before it is built. A manifest that fails to load or a build that raises
+    is reported and the watch goes on with the last good manifest. Runs until
+    interrupted."""
+    def load():
+        manifest = load_manifest(manifest_file)
+        if on_load:
+            on_load(manifest)
+        return manifest
+
+    def build(manifest):
+        try:
+            build_manifest(manifest, **build_args)
+        except Exception as error:
+            print("build failed:", error, flush=True)
+        if on_build:
+            on_build()
+
+    manifest = load()
+    build(manifest)
+
+    def watched():
+        paths = {p for f in manifest["figures"] for p in figure_inputs(f)}
+        return {p: _file_state(p) for p in paths | {manifest_file}}
+
+    state = watched()
+    print("watching", len(state), "files, ctrl-c to stop", flush=True)
+    try:
+        while True:
+            time.sleep(interval)
+            now     = watched()
+            changed = [p for p in now if now[p] != state.get(p)]
+            if not changed:
+                continue
+
+            # NOTE: wait until the renderer is done writing
+            while True:
+                time.sleep(interval)
+                settled = watched()
+                if settled == now:
+                    break
+                now = settled
+            state = now
+
+            if manifest_file in changed:
+                # NOTE: an editor may save the manifest half way, keep the
+                #   old one until the next save parses
+                try:
+                    manifest = load()
+                except Exception as error:
+                    print()
+                    print("could not reload", manifest_file + ":", error, flush=True)
+                    continue
+                figures  = manifest["figures"]
+                state    = watched()
+            else:
+                figures  = [f for f in manifest["figures"] if set(figure_inputs(f)) & set(changed)]
+
+            print()
+            print("changed:", ", ".join(changed))
+            print("rebuilding:", ", ".join(f["output"] for f in figures), flush=True)
+            build(dict(manifest, figures=figures))
+    except KeyboardInterrupt:
+        pass
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build LaTeX image comparison figures from a manifest.")
+    parser.add_argument("manifest", nargs="?", default=str(Path(__file__).parent/"figures.json"),
+                        help="JSON or TOML file describing the figures")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of tasks to run at once (default: manifest 'jobs' or all cores)")
+    parser.add_argument("--no-compile", action="store_true", help="only write the .tex files")
+    parser.add_argument("--batch", metavar="TEX", nargs="?", const="figures_batch.tex", default=None,
+                        help="compile all figures in one pdflatex run and split the pages")
+    parser.add_argument("--dpi", type=float, default=None,
+                        help="resample embedded images down to this resolution at their printed size")
+    parser.add_argument("--intermediate", choices=list(intermediate_modes), default=None,
+                        help="how generated crops and FLIP maps are encoded; 'final' compresses the most "
+                             "(default: manifest 'intermediate_mode' or fast)")
+    parser.add_argument("--flip-backend", choices=["subprocess", "inprocess"], default=None,
+                        help="run flip.py per pair or FLIP in this process (default: manifest 'flip_backend' or subprocess)")
+    parser.add_argument("--trace", metavar="JSON", help="write a Chrome trace-event file of all pipeline stages")
+    parser.add_argument("--watch", metavar="SECONDS", type=float, nargs="?", const=0.5, default=None,
+                        help="keep running and rebuild the figures whose images change (poll interval)")
+    parser.add_argument("--tex-only", "--dry-run", action="store_true",
+                        help="only lay out the .tex files from the image headers; no decoding, FLIP, metrics or pdflatex")
+    parser.add_argument("--preview", action="store_true",
+                        help="estimate metrics and FLIP from samples, with error bars; figures are marked as previews")
+    parser.add_argument("--raster", action="store_true",
+                        help="write a PNG preview of every figure (next to its .tex name) instead of running LaTeX")
+    parser.add_argument("--shard", metavar="I/N", default=None,
+                        help="only compute FLIP maps and metrics of shard I of N into the artifact directory")
+    parser.add_argument("--merge", action="store_true",
+                        help="build the figures from the results of all shards in the artifact directory")
+    parser.add_argument("--artifacts", metavar="DIR", default=artifacts_dir,
+                        help="directory shared by the shards and the merge (default: %(default)s)")
+    parser.add_argument("--export", metavar="FILE", default=None,
+                        help="write every stored metric to FILE (.csv or .json) and exit without building")
+    args = parser.parse_args(argv)
+
+    if args.export:
+        print("exported", export_metrics(args.export), "metric values to", args.export)
+        return 0
+
+    global tex_only
+    tex_only = args.tex_only
+    manifest = load_manifest(args.manifest)
+    apply_manifest_settings(manifest, dpi=args.dpi, preview=args.preview,
+                            intermediate=args.intermediate, flip=args.flip_backend)
+    if tex_only:
+        args.no_compile = True
+
+    def report():
+        print_trace_summary()
+        if args.trace:
+            write_chrome_trace(args.trace)
+        trace_events.clear()
+
+    if args.raster:
+        failed = []
+        for figure in manifest["figures"]:
+            png = str(Path(figure["output"]).with_suffix(".png"))
+            try:
+                raster_figure(png, figure["type"], **figure.get("args", {}))
+                print("wrote", png)
+            except Exception as error:
+                print("failed:", png + ":", error)
+                failed.append(png)
+        report()
+        return 1 if failed else 0
+
+    if args.shard:
+        index, count = (int(n) for n in args.shard.split("/"))
+        failed = build_shard(manifest, index, count, artifacts=args.artifacts, jobs=args.jobs)
+        report()
+        return 1 if failed else 0
+
+    if args.merge:
+        failed = merge_shards(manifest, artifacts=args.artifacts, jobs=args.jobs,
+                              compile=not args.no_compile, batch=args.batch)
+        report()
+        return 1 if failed else 0
+
+    if args.watch is not None:
+        watch_manifest(args.manifest, interval=args.watch, on_build=report,
+                       on_load=lambda manifest: apply_manifest_settings(manifest, dpi=args.dpi, preview=args.preview,
+                                                                        intermediate=args.intermediate,
+                                                                        flip=args.flip_backend),
+                       jobs=args.jobs, compile=not args.no_compile, batch=args.batch)
+        return 0
+
+    failed = build_manifest(manifest, jobs=args.jobs, compile=not args.no_compile,
+                            batch=args.batch)
+    report()
+    return 1 if failed else 0
+
 
 if __name__ ==  "__main__":
-    # # one line
-    # llist = []
-    # one_line_figure(ref=("4000spp", "./images/eaw_japan-4000spp.png"),
-    #                 box1=(7.85, 7.5, 0.8), box2=(5.1, 7.3, 0.5),
-    #                 cmp1=("1 iter", "./images/eaw_japan-4spp-1-iter-p+n.png"),
-    #                 cmp2=("2 iter", "./images/eaw_japan-4spp-2-iter-p+n.png"),
-    #                 out_list=llist)
-    # make_latex_standalone("one_line.tex", llist);
-
-    # # long line
-    # llist = []
-    # one_line_figure(box1=(7.85, 7.5, 0.8), box2=(5.1, 7.3, 0.5),
-    #                 ref_crop=(4, 2, 1, 1),
-    #                 ref=( "4000spp", "./images/eaw_japan-4000spp.png"),
-    #                 cmp1=("1 iter",  "./images/eaw_japan-4spp-1-iter-p+n.png"),
-    #                 cmp2=("2 iter",  "./images/eaw_japan-4spp-2-iter-p+n.png"),
-    #                 cmp3=("3 iter",  "./images/eaw_japan-4spp-3-iter-p+n.png"),
-    #                 cmp4=("4 iter",  "./images/eaw_japan-4spp-4-iter-p+n.png"),
-    #                 cmp5=("5 iter",  "./images/eaw_japan-4spp-5-iter-p+n.png"),
-    #                 out_list=llist)
-    # make_latex_standalone("long_line.tex", llist)
-
-    # vertical flip
-    llist = []
-    vertical_flip_figure(box1=(0.5, 2.5, 3.5), box2=(5.5, 2, 3),
-                         ref_crop=(0, 1.5, 0, 2),
-                         ref=( "4000spp", "./images/eaw_japan-4000spp.png"),
-                         cmp1=("1 iter",  "./images/eaw_japan-4spp-1-iter-p+n.png"),
-                         cmp2=("2 iter",  "./images/eaw_japan-4spp-2-iter-p+n.png"),
-                         cmp3=("3 iter",  "./images/eaw_japan-4spp-3-iter-p+n.png"),
-                         cmp4=("4 iter",  "./images/eaw_japan-4spp-4-iter-p+n.png"),
-                         cmp5=("5 iter",  "./images/eaw_japan-4spp-5-iter-p+n.png"),
-                         out_list=llist)
-    make_latex_standalone("vertical_flip.tex", llist)
-
-    # # # horiz iterations
-    # llist = []
-    # horizontal_iterations_figure(box1=(0.5, 2.5, 3.5), box2=(5.5, 2, 3),
-    #                              ref_crop=(0, 1.5, 0, 2),
-    #                              ref=( "4000spp", "./images/eaw_japan-4000spp.png"),
-    #                              cmp1=("C+P+N",
-    #                                    "./images/eaw_japan-4spp-1-iter-p+n.png",
-    #                                    "./images/eaw_japan-4spp-2-iter-p+n.png",
-    #                                    "./images/eaw_japan-4spp-3-iter-p+n.png",
-    #                                    "./images/eaw_japan-4spp-4-iter-p+n.png",
-    #                                    "./images/eaw_japan-4spp-5-iter-p+n.png"),
-    #                              cmp2=("C+P",
-    #                                    "./images/eaw_japan-4spp-1-iter-p.png",
-    #                                    "./images/eaw_japan-4spp-2-iter-p.png",
-    #                                    "./images/eaw_japan-4spp-3-iter-p.png",
-    #                                    "./images/eaw_japan-4spp-4-iter-p.png",
-    #                                    "./images/eaw_japan-4spp-5-iter-p.png"),
-    #                              cmp3=("C+N",
-    #                                    "./images/eaw_japan-4spp-1-iter-n.png",
-    #                                    "./images/eaw_japan-4spp-2-iter-n.png",
-    #                                    "./images/eaw_japan-4spp-3-iter-n.png",
-    #                                    "./images/eaw_japan-4spp-4-iter-n.png",
-    #                                    "./images/eaw_japan-4spp-5-iter-n.png"),
-    #                              cmp4=("C",
-    #                                    "./images/eaw_japan-4spp-1-iter.png",
-    #                                    "./images/eaw_japan-4spp-2-iter.png",
-    #                                    "./images/eaw_japan-4spp-3-iter.png",
-    #                                    "./images/eaw_japan-4spp-4-iter.png",
-    #                                    "./images/eaw_japan-4spp-5-iter.png"),
-    #                              out_list=llist)
-    # make_latex_standalone("horiz_iterations.tex", llist)
+    sys.exit(main())